@@ -0,0 +1,165 @@
+import asyncio
+import hashlib
+import json
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import websockets
+from websockets.asyncio.server import ServerConnection, serve
+
+
+class _LogHandler(BaseHTTPRequestHandler):
+    """Minimal stand-in for the platform's /log/artifacts and /log/events endpoints"""
+    platform: 'FakePlatform'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body:dict):
+        raw = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+
+        if self.path.endswith('/log/artifacts'):
+            # The multipart envelope is hashed as a whole, which is enough
+            # to give identical uploads identical hashes
+            sha1 = hashlib.sha1(body).hexdigest()
+            self.platform.count('artifacts')
+            self._reply(201, {'name': 'artifact', 'size': length, 'sha1': sha1})
+        elif self.path.endswith('/log/events'):
+            event = json.loads(body)
+            event['id'] = str(uuid.uuid4())
+            event.setdefault('timestamp', time.time())
+            self.platform.count('events')
+            self._reply(200, event)
+        else:
+            self._reply(404, {'detail': 'Not Found'})
+
+
+class FakePlatform:
+    """Local stand-in for the SatOP platform
+
+    Runs a websocket server speaking the ground station protocol (``hello``
+    handshake followed by requests) and an HTTP server for the logging API,
+    each in their own thread so the client under test owns its event loop.
+    """
+
+    def __init__(self, host='127.0.0.1'):
+        self.host = host
+        self.ws_port = None
+        self.http_port = None
+        self.counters: dict[str, int] = dict()
+        self._counter_lock = threading.Lock()
+        self._loop = asyncio.new_event_loop()
+        self._connected = threading.Event()
+        self._ws: ServerConnection | None = None
+        self._pending: dict[str, tuple[float, asyncio.Future]] = dict()
+
+    def count(self, name:str):
+        with self._counter_lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    def start(self):
+        http_handler = type('Handler', (_LogHandler,), {'platform': self})
+        self._http = ThreadingHTTPServer((self.host, 0), http_handler)
+        self.http_port = self._http.server_address[1]
+        threading.Thread(target=self._http.serve_forever, daemon=True).start()
+
+        started = threading.Event()
+        threading.Thread(target=self._run_loop, args=(started,), daemon=True).start()
+        started.wait()
+
+    def _run_loop(self, started:threading.Event):
+        asyncio.set_event_loop(self._loop)
+
+        async def start_server():
+            self._server = await serve(self._handle, self.host, 0, max_size=None)
+            self.ws_port = self._server.sockets[0].getsockname()[1]
+            started.set()
+
+        self._loop.run_until_complete(start_server())
+        self._loop.run_forever()
+
+    def stop(self):
+        async def close():
+            self._server.close()
+            await self._server.wait_closed()
+        asyncio.run_coroutine_threadsafe(close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._http.shutdown()
+
+    def wait_connected(self, timeout=10):
+        if not self._connected.wait(timeout):
+            raise TimeoutError('Client did not connect')
+
+    async def _handle(self, ws:ServerConnection):
+        hello = json.loads(await ws.recv())
+        assert hello['type'] == 'hello'
+        await ws.send(json.dumps({
+            'message': 'OK',
+            'id': hello.get('id', str(uuid.uuid4()))
+        }))
+        self._ws = ws
+        self._connected.set()
+
+        try:
+            async for raw in ws:
+                received = time.perf_counter()
+                msg = json.loads(raw)
+                pending = self._pending.pop(msg.get('in_response_to'), None)
+                if pending:
+                    sent, fut = pending
+                    fut.set_result((received - sent, msg))
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self._ws = None
+            self._connected.clear()
+
+    async def _request(self, message_type:str, data:dict, frames:list):
+        req_id = str(uuid.uuid4())
+        fut = self._loop.create_future()
+        msg = {
+            'type': message_type,
+            'request_id': req_id,
+            'data': data,
+            'frames': len(frames)
+        }
+        self._pending[req_id] = (time.perf_counter(), fut)
+        await self._ws.send(json.dumps(msg))
+        for frame in frames:
+            await self._ws.send(frame)
+        return await fut
+
+    async def _request_many(self, message_type:str, data:dict, frames:list, count:int, window:int):
+        sem = asyncio.Semaphore(window)
+
+        async def one():
+            async with sem:
+                return await self._request(message_type, data, frames)
+
+        return await asyncio.gather(*(one() for _ in range(count)))
+
+    def request(self, message_type:str, data:dict|None=None, frames:list|None=None) -> Future:
+        """Send a single request to the client, resolving to (latency_seconds, response)"""
+        return asyncio.run_coroutine_threadsafe(
+            self._request(message_type, data or dict(), frames or []), self._loop)
+
+    def request_many(self, message_type:str, count:int, data:dict|None=None, frames:list|None=None, window=1) -> Future:
+        """Send ``count`` identical requests keeping at most ``window`` in flight"""
+        return asyncio.run_coroutine_threadsafe(
+            self._request_many(message_type, data or dict(), frames or [], count, window), self._loop)
+
+    def disconnect_client(self):
+        if self._ws:
+            asyncio.run_coroutine_threadsafe(self._ws.close(), self._loop).result()
@@ -0,0 +1,417 @@
+"""End-to-end benchmarks for the SatOP ground station client
+
+Runs SatopClient, SatopApi, CSH and CSHScheduler against a local fake
+platform (see fake_platform.py) and a stub slash library (see stub_slash.c),
+so no real platform or libcsh.so is needed.
+
+    python3 benchmarks/run_benchmarks.py --requests 1000 --csh-latency-us 500
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import tracemalloc
+from datetime import timedelta
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).parent.resolve()
+SRC_DIR = BENCH_DIR.parent / 'satop_gsc'
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--requests', type=int, default=500, help='requests per client/api/csh scenario')
+parser.add_argument('--window', type=int, default=1, help='requests kept in flight by the platform')
+parser.add_argument('--payload-bytes', type=int, default=1024, help='size of echo payloads')
+parser.add_argument('--csh-latency-us', type=int, default=1000, help='stub latency per CSH command')
+parser.add_argument('--csh-output-bytes', type=int, default=256, help='stub output per CSH command (keep below the pipe buffer size)')
+parser.add_argument('--observation-requests', type=int, default=5)
+parser.add_argument('--observation-days', type=int, default=1)
+parser.add_argument('--contexts', type=int, default=2, help='CSH contexts in the pool, satellites are routed round-robin')
+parser.add_argument('--scheduled', type=int, default=20, help='scripts to schedule')
+parser.add_argument('--schedule-spacing', type=float, default=0.05, help='seconds between scheduled scripts')
+parser.add_argument('--telemetry-capacity', type=int, default=100000)
+parser.add_argument('--overload-requests', type=int, default=200, help='csh requests sent at once in the overload scenarios')
+parser.add_argument('--overload-queue', type=int, default=16)
+parser.add_argument('--timeout', type=float, default=300, help='seconds to wait for the responses of a client scenario')
+parser.add_argument('--only', nargs='*', help='run only scenarios with these name prefixes')
+parser.add_argument('--tracemalloc', action='store_true', help='also report peak Python allocations (slows everything down)')
+parser.add_argument('--verbose', action='store_true', help='keep the output of the code under test')
+parser.add_argument('--json', type=Path, help='write results to this file')
+
+
+def build_stub(out_dir:Path) -> Path:
+    lib = out_dir / 'libstubslash.so'
+    subprocess.run(['cc', '-shared', '-fPIC', '-O2', '-o', str(lib), str(BENCH_DIR / 'stub_slash.c')], check=True)
+    return lib
+
+
+@contextlib.contextmanager
+def quiet(enabled:bool):
+    """Silence stdout at the file descriptor level, as CSH writes to fd 1 directly"""
+    if not enabled:
+        yield
+        return
+    sys.stdout.flush()
+    saved = os.dup(1)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved, 1)
+        os.close(saved)
+        os.close(devnull)
+
+
+def percentile(sorted_values:list[float], q:float) -> float:
+    if not sorted_values:
+        return float('nan')
+    return sorted_values[min(len(sorted_values) - 1, round(q * (len(sorted_values) - 1)))]
+
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.results: list[dict] = []
+
+    def selected(self, name:str) -> bool:
+        return not self.args.only or any(name.startswith(p) for p in self.args.only)
+
+    @contextlib.contextmanager
+    def scenario(self, name:str):
+        """Times a scenario; the body appends per-operation latencies (seconds) to the yielded list"""
+        latencies = []
+        if self.args.tracemalloc:
+            tracemalloc.start()
+        t0 = time.perf_counter()
+        with quiet(not self.args.verbose):
+            yield latencies
+        elapsed = time.perf_counter() - t0
+        alloc_peak = None
+        if self.args.tracemalloc:
+            alloc_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        self.add_result(name, latencies, elapsed, alloc_peak)
+
+    def add_result(self, name:str, latencies:list[float], elapsed:float, alloc_peak:int|None=None):
+        latencies.sort()
+        self.results.append({
+            'name': name,
+            'count': len(latencies),
+            'seconds': elapsed,
+            'rate': len(latencies) / elapsed if elapsed else float('nan'),
+            'p50_ms': percentile(latencies, 0.50) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+            'max_ms': (latencies[-1] if latencies else float('nan')) * 1000,
+            'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'alloc_peak_mb': alloc_peak / 2**20 if alloc_peak is not None else None,
+        })
+
+    def report(self):
+        header = f'{"scenario":<32} {"count":>6} {"seconds":>8} {"ops/s":>9} {"p50 ms":>8} {"p99 ms":>8} {"max ms":>8} {"rss MB":>7}'
+        if self.args.tracemalloc:
+            header += f' {"alloc MB":>8}'
+        print(header)
+        for r in self.results:
+            line = (f'{r["name"]:<32} {r["count"]:>6} {r["seconds"]:>8.2f} {r["rate"]:>9.1f} '
+                    f'{r["p50_ms"]:>8.2f} {r["p99_ms"]:>8.2f} {r["max_ms"]:>8.2f} {r["max_rss_mb"]:>7.1f}')
+            if self.args.tracemalloc:
+                line += f' {r["alloc_peak_mb"]:>8.2f}'
+            print(line)
+
+        if self.args.json:
+            with open(self.args.json, 'w') as f:
+                json.dump({'config': {k: str(v) for k,v in vars(self.args).items()}, 'results': self.results}, f, indent=2)
+
+
+def run(args, tmp:Path):
+    import websockets
+    from fake_platform import FakePlatform
+    from csh.csh_wrapper import CSH
+    from csh.csh_pool import CSHPool
+    from satop_api import SatopApi
+    from satop_client import SatopClient
+    from scheduler import CSHScheduler, utcnow
+    from observations import PassHorizon, get_passes
+    from response_cache import CachePolicy
+    from telemetry import TelemetryStore
+    from admission import Admission
+
+    bench = Bench(args)
+    n = args.requests
+
+    platform = FakePlatform()
+    platform.start()
+
+    client = SatopClient('127.0.0.1', platform.ws_port, id_file=tmp / '.id')
+    api = SatopApi(client.id, '127.0.0.1', platform.http_port, https=False)
+    csh = CSH()
+    pool = CSHPool({f'ctx-{i}': {'init': ['csp init']} for i in range(args.contexts)}, default='ctx-0')
+    pool.start()
+    satellites = [f'SAT-{i}' for i in range(args.contexts)]
+    pool.routes = {sat: f'ctx-{i}' for i,sat in enumerate(satellites)}
+    telemetry = TelemetryStore(tmp / '.telemetry', args.telemetry_capacity)
+
+    if bench.selected('csh.execute'):
+        with bench.scenario('csh.execute') as lat:
+            for i in range(n):
+                t = time.perf_counter()
+                csh.execute(f'ping {i}')
+                lat.append(time.perf_counter() - t)
+
+    if bench.selected('csh.context'):
+        context = pool.context()
+        with bench.scenario('csh.context.execute') as lat:
+            for i in range(n):
+                t = time.perf_counter()
+                context.execute(f'ping {i}')
+                lat.append(time.perf_counter() - t)
+
+        def run_on(context, lat):
+            for i in range(n):
+                t = time.perf_counter()
+                context.execute_script(['ident', f'ping {i}'])
+                lat.append(time.perf_counter() - t)
+
+        with bench.scenario('csh.context.parallel_scripts') as lat:
+            threads = [threading.Thread(target=run_on, args=(c, lat)) for c in pool.contexts.values()]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+    if bench.selected('api.'):
+        script = ['ident', 'ping 1']
+        result = csh.execute_script(script)
+        sha1 = None
+        with bench.scenario('api.log_received_commands') as lat:
+            for _ in range(n):
+                t = time.perf_counter()
+                _, sha1 = api.log_received_commands(script)
+                lat.append(time.perf_counter() - t)
+        with bench.scenario('api.log_executed_start') as lat:
+            for _ in range(n):
+                t = time.perf_counter()
+                api.log_executed_commands_start(sha1, timedelta(milliseconds=1))
+                lat.append(time.perf_counter() - t)
+        with bench.scenario('api.log_executed_finish') as lat:
+            for _ in range(n):
+                t = time.perf_counter()
+                api.log_executed_commands_finish(sha1, result, timedelta(milliseconds=1))
+                lat.append(time.perf_counter() - t)
+
+    if bench.selected('client.'):
+        # Mirrors the responders in gs_client.py, which can't be imported
+        # as it parses arguments and connects at import time
+        @client.add_responder('echo')
+        def echo_responder(data:dict):
+            api.log_received_echo(data)
+            return data
+
+        @client.add_responder('csh')
+        def csh_responder(data:dict):
+            script = data.get('script', [])
+            _, artifact_sha1 = api.log_received_commands(script)
+            api.log_executed_commands_start(artifact_sha1)
+            res = pool.for_satellite(data.get('satellite')).execute_script(script)
+            telemetry.ingest(res)
+            api.log_executed_commands_finish(artifact_sha1, res)
+            return res
+
+        def observe_responder(satellite, min_degree=30, delta_days=7):
+            return {'observations': get_passes(satellite, min_degree, delta_days).to_records()}
+        client.add_responder('get_observations')(observe_responder)
+
+        @client.add_responder('get_observations_columns')
+        def observe_columns_responder(satellite, min_degree=30, delta_days=7):
+            return {'observations': get_passes(satellite, min_degree, delta_days).to_columns()}
+        client.add_responder('get_observations_cached', cache=CachePolicy(ttl=3600))(observe_responder)
+
+        horizon = PassHorizon(days=args.observation_days)
+        if bench.selected('client.get_observations_horizon'):
+            horizon.refresh()
+
+        @client.add_responder('get_observations_horizon')
+        def observe_horizon_responder(satellite, min_degree=30, delta_days=7):
+            return {'observations': horizon.get_passes(satellite, min_degree, delta_days).to_records()}
+
+        client.add_responder('csh_admitted', admission=Admission(args.contexts, args.overload_queue))(csh_responder)
+
+        async def client_main():
+            await client.connect()
+            await client.run()
+
+        client_errors = []
+
+        def client_thread():
+            try:
+                asyncio.run(client_main())
+            except websockets.ConnectionClosed:
+                # Disconnected by the platform after the last scenario
+                pass
+            except Exception as e:
+                client_errors.append(e)
+                traceback.print_exc()
+
+        def responses(future):
+            try:
+                return future.result(args.timeout)
+            except TimeoutError:
+                raise RuntimeError(f'No responses from the client within {args.timeout} s') from (client_errors[0] if client_errors else None)
+
+        threading.Thread(target=client_thread, daemon=True).start()
+        platform.wait_connected()
+
+        def drive(name, message_type, count, data=None, frames=None):
+            with bench.scenario(name) as lat:
+                for latency, response in responses(platform.request_many(message_type, count, data, frames, args.window)):
+                    if 'error' in response:
+                        raise RuntimeError(f'{name}: {response["error"]}')
+                    lat.append(latency)
+
+        drive('client.echo', 'echo', n, {'payload': 'x' * args.payload_bytes})
+        drive('client.csh', 'csh', n, {'script': ['ident', 'ping 1']})
+        drive('client.get_observations', 'get_observations', args.observation_requests,
+              {'satellite': 'DISCO-1', 'delta_days': args.observation_days})
+        drive('client.get_observations_columns', 'get_observations_columns', args.observation_requests,
+              {'satellite': 'DISCO-1', 'delta_days': args.observation_days})
+        drive('client.get_observations_horizon', 'get_observations_horizon', n,
+              {'satellite': 'DISCO-1', 'delta_days': args.observation_days})
+        drive('client.get_observations_cached', 'get_observations_cached', n,
+              {'satellite': 'DISCO-1', 'delta_days': args.observation_days})
+
+        def overload(name, flood_type):
+            # Echo latency while a burst of csh requests is handled, and the
+            # latency of the csh requests that were not rejected
+            t0 = time.perf_counter()
+            flood = platform.request_many(flood_type, args.overload_requests, {'script': ['ident', 'ping 1']}, window=args.overload_requests)
+            drive(f'{name}.echo', 'echo', n, {'payload': 'x' * args.payload_bytes})
+            bench.add_result(f'{name}.csh_accepted', [l for l, r in responses(flood) if 'error' not in r], time.perf_counter() - t0)
+
+        if bench.selected('client.overload'):
+            overload('client.overload_inline', 'csh')
+            overload('client.overload_admitted', 'csh_admitted')
+
+        platform.disconnect_client()
+
+    if bench.selected('scheduler'):
+        done = threading.Semaphore(0)
+        lateness = []
+        start_lateness = []
+
+        class LatenessApi(SatopApi):
+            def log_executed_commands_start(self, script_sha1, timing_deltastart=None):
+                start_lateness.append(timing_deltastart.total_seconds())
+                return super().log_executed_commands_start(script_sha1, timing_deltastart)
+
+        class LatenessScheduler(CSHScheduler):
+            def execute_commands(self, commands, id, artifact_hash):
+                lateness.append((utcnow() - self.scheduled[id].time).total_seconds())
+                try:
+                    super().execute_commands(commands, id, artifact_hash)
+                finally:
+                    done.release()
+
+        scheduler = LatenessScheduler(pool, LatenessApi(client.id, '127.0.0.1', platform.http_port, https=False))
+        m = args.scheduled
+        t0 = time.perf_counter()
+        with bench.scenario('scheduler.call_lateness') as lat:
+            start = utcnow() + timedelta(seconds=1 + 0.01 * m)
+            for i in range(m):
+                scheduler.add(start + timedelta(seconds=i * args.schedule_spacing), ['ident', 'ping 1'], f'bench-{i}',
+                              satellite=satellites[i % len(satellites)])
+            for _ in range(m):
+                done.acquire()
+            lat.extend(lateness)
+        bench.add_result('scheduler.start_lateness', start_lateness, time.perf_counter() - t0)
+        scheduler.stop()
+
+    if bench.selected('scheduler.add'):
+        # Scheduled far ahead and dropped again, only the cost of adding is measured
+        scheduler = CSHScheduler(pool, api)
+        later = utcnow() + timedelta(days=1)
+        scripts = [['ident', f'ping {i % 10}'] for i in range(n)]
+        with bench.scenario('scheduler.add') as lat:
+            for i, script in enumerate(scripts):
+                t = time.perf_counter()
+                scheduler.add(later + timedelta(minutes=i), script, f'add-{i}', satellite=satellites[i % len(satellites)])
+                lat.append(time.perf_counter() - t)
+        with bench.scenario('scheduler.add_many') as lat:
+            t = time.perf_counter()
+            scheduler.add_many([(later + timedelta(minutes=i), script, f'add-many-{i}', satellites[i % len(satellites)])
+                                for i, script in enumerate(scripts)])
+            lat.append(time.perf_counter() - t)
+        scheduler.stop()
+
+    if bench.selected('observations.horizon_refresh'):
+        # One full search, then ticks a minute apart only searching the new tail
+        horizon = PassHorizon(days=args.observation_days)
+        now = time.time()
+        with bench.scenario('observations.horizon_full') as lat:
+            t = time.perf_counter()
+            horizon.refresh(now)
+            lat.append(time.perf_counter() - t)
+        with bench.scenario('observations.horizon_refresh') as lat:
+            for i in range(1, n + 1):
+                t = time.perf_counter()
+                horizon.refresh(now + 60 * i)
+                lat.append(time.perf_counter() - t)
+
+    if bench.selected('telemetry'):
+        # 'get' output of 20 parameters and a ping, as one script result
+        out = ''.join(f' {i}:2  param_{i:<14} = {i * 1.5} mV\n' for i in range(20))
+        results = [
+            {'in': 'get -n 2', 'out': out, 'return_code': {'name': 'SLASH_SUCCESS', 'value': 0}},
+            {'in': 'ping 2', 'out': 'Ping node 2 size 1 timeout 1000: Reply in 3 [ms]\n', 'return_code': {'name': 'SLASH_SUCCESS', 'value': 0}},
+        ]
+        with bench.scenario('telemetry.ingest') as lat:
+            for _ in range(n):
+                t = time.perf_counter()
+                telemetry.ingest(results)
+                lat.append(time.perf_counter() - t)
+        # Fill the buffer, so queries scan all of it
+        while len(telemetry) < telemetry.capacity:
+            telemetry.ingest(results)
+        with bench.scenario('telemetry.query_latest') as lat:
+            for _ in range(n):
+                t = time.perf_counter()
+                telemetry.query(latest=True)
+                lat.append(time.perf_counter() - t)
+        with bench.scenario('telemetry.query_range') as lat:
+            now = time.time()
+            for _ in range(n):
+                t = time.perf_counter()
+                telemetry.query('param_7', node=2, start=now - 60, end=now)
+                lat.append(time.perf_counter() - t)
+
+    pool.close()
+    telemetry.close()
+
+    platform.stop()
+    bench.report()
+
+
+def main():
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as d:
+        lib = build_stub(Path(d))
+        # The slash library is loaded when csh_wrapper is imported
+        os.environ['SATOP_GSC_LIBCSH'] = str(lib)
+        os.environ['STUB_SLASH_LATENCY_US'] = str(args.csh_latency_us)
+        os.environ['STUB_SLASH_OUTPUT_BYTES'] = str(args.csh_output_bytes)
+        sys.path.insert(0, str(SRC_DIR))
+        sys.path.insert(0, str(BENCH_DIR))
+        run(args, Path(d))
+
+
+if __name__ == '__main__':
+    main()
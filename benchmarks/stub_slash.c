@@ -0,0 +1,79 @@
+/*
+ * Stand-in for libcsh.so exposing the slash entry points used by
+ * satop_gsc/csh/csh_wrapper.py.
+ *
+ * Every command sleeps STUB_SLASH_LATENCY_US microseconds and writes
+ * STUB_SLASH_OUTPUT_BYTES bytes to stdout before returning SLASH_SUCCESS.
+ * Commands starting with "fail" return SLASH_EINVAL.
+ *
+ * Build: cc -shared -fPIC -O2 -o libstubslash.so stub_slash.c
+ */
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+
+#define SLASH_SUCCESS ( 0)
+#define SLASH_EINVAL  (-2)
+
+struct slash {
+	int fd_write;
+	int fd_read;
+	unsigned long latency_us;
+	unsigned long output_bytes;
+};
+
+static unsigned long env_ulong(const char *name, unsigned long def)
+{
+	const char *v = getenv(name);
+	return v ? strtoul(v, NULL, 10) : def;
+}
+
+struct slash *slash_create(size_t line_size, size_t history_size)
+{
+	(void) line_size;
+	(void) history_size;
+
+	struct slash *slash = calloc(1, sizeof(*slash));
+	if (!slash)
+		return NULL;
+
+	slash->fd_write = 1;
+	slash->latency_us = env_ulong("STUB_SLASH_LATENCY_US", 1000);
+	slash->output_bytes = env_ulong("STUB_SLASH_OUTPUT_BYTES", 256);
+	return slash;
+}
+
+void slash_destroy(struct slash *slash)
+{
+	free(slash);
+}
+
+int slash_execute(struct slash *slash, char *line)
+{
+	if (slash->latency_us) {
+		struct timespec ts = {
+			.tv_sec = slash->latency_us / 1000000,
+			.tv_nsec = (slash->latency_us % 1000000) * 1000,
+		};
+		nanosleep(&ts, NULL);
+	}
+
+	if (strncmp(line, "fail", 4) == 0) {
+		printf("stub: %s failed\n", line);
+		return SLASH_EINVAL;
+	}
+
+	/* Line based output of at most 64 bytes per line, newline included */
+	static const char filler[64] =
+		"stub output ...................................................";
+	unsigned long written = 0;
+	while (written < slash->output_bytes) {
+		unsigned long n = slash->output_bytes - written;
+		if (n > sizeof(filler))
+			n = sizeof(filler);
+		printf("%.*s\n", (int) n - 1, filler);
+		written += n;
+	}
+	return SLASH_SUCCESS;
+}
@@ -0,0 +1,58 @@
+import asyncio
+import dataclasses
+import time
+
+@dataclasses.dataclass
+class Admission:
+    """Concurrency limit and queue bound of a message type
+
+    Requests of a type with an admission policy run in worker threads, so
+    they don't hold up other requests while they run.
+
+    Args:
+        concurrency (int): requests running at the same time
+        queue (int): requests waiting for a free slot, further requests are
+            rejected with a 503 error
+    """
+    concurrency: int = 1
+    queue: int = 16
+
+class AdmissionQueue:
+    """Requests of one message type admitted by an :class:`Admission` policy
+
+    Only used from the event loop.
+    """
+
+    def __init__(self, policy:Admission):
+        self.policy = policy
+        self.pending = 0
+        self.full_since: float | None = None
+        self.slots = asyncio.Semaphore(policy.concurrency)
+        self._room = asyncio.Event()
+        self._room.set()
+
+    @property
+    def limit(self) -> int:
+        return self.policy.concurrency + self.policy.queue
+
+    def try_admit(self) -> bool:
+        if self.pending >= self.limit:
+            return False
+        self.pending += 1
+        if self.pending >= self.limit:
+            self.full_since = time.monotonic()
+            self._room.clear()
+        return True
+
+    def release(self):
+        self.pending -= 1
+        if self.pending < self.limit:
+            self.full_since = None
+            self._room.set()
+
+    def full_for(self) -> float:
+        """Seconds the queue has been full, 0 if it isn't"""
+        return 0 if self.full_since is None else time.monotonic() - self.full_since
+
+    async def wait_for_room(self):
+        await self._room.wait()
@@ -0,0 +1,3 @@
+def command_name(cmd:str) -> str:
+    """Name of the command run by a CSH line, e.g. 'ping' for 'ping -n 3'"""
+    return cmd.split(maxsplit=1)[0] if cmd.strip() else ''
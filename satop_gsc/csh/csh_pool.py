@@ -0,0 +1,173 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing.connection import Pipe
+import tracing
+from csh import command_name
+from csh.csh_wrapper import SLASH_RETURN
+from metrics import registry
+
+trace = tracing.get_tracer('csh')
+
+WORKER = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'csh_worker.py')
+
+_local = threading.local()
+
+def take_script_seconds() -> list[tuple[str, float]]:
+    """Commands of the last script run by this thread and the seconds they took in the worker, then forgets them"""
+    seconds = getattr(_local, 'script_seconds', [])
+    _local.script_seconds = []
+    return seconds
+
+class CSHContext:
+    """A CSH context running in its own worker process
+
+    libcsh keeps its CSP stack in process global state and CSH output is
+    captured by redirecting the process' stdout, so contexts can only run in
+    parallel in separate processes. Has the same ``execute`` and
+    ``execute_script`` interface as :class:`csh.csh_wrapper.CSH`; calls on
+    the same context are serialized by ``lock``, which callers may also hold
+    to run several calls back to back.
+    """
+
+    def __init__(self, name:str, init:list[str], slash_linewidth=64, slash_history=1024, debug=False):
+        self.name = name
+        self.init = init
+        self.config = {
+            'init': init,
+            'slash_linewidth': slash_linewidth,
+            'slash_history': slash_history,
+            'debug': debug,
+            'tracing': tracing.current_config(),
+        }
+        self.lock = threading.RLock()
+        self._process: subprocess.Popen | None = None
+        self._conn = None
+
+    def start(self):
+        """Launch the worker process, run ``wait_ready`` to wait for the init commands to finish"""
+        conn, child_conn = Pipe()
+        self._process = subprocess.Popen(
+            [sys.executable, WORKER, str(child_conn.fileno()), json.dumps(self.config)],
+            pass_fds=(child_conn.fileno(),)
+        )
+        child_conn.close()
+        self._conn = conn
+
+    def wait_ready(self, timeout=30):
+        if not self._conn.poll(timeout):
+            raise TimeoutError(f'CSH context {self.name} did not start')
+        _, (init_results, seconds) = self._recv()
+        self._record_commands(init_results, seconds)
+        for r in init_results:
+            trace.info('[%s] %s: %s', self.name, r['in'], r['return_code']['name'])
+
+    def _record_command(self, cmd:str, seconds:float, result:str):
+        # Recorded here, as the metrics of the worker process are never served.
+        # Labelled by command name only, so arguments don't create new series
+        command = command_name(cmd)
+        registry.histogram('csh_command_seconds', context=self.name, command=command).record(seconds)
+        if result != SLASH_RETURN.SLASH_SUCCESS.name:
+            registry.counter('csh_command_failures_total', context=self.name, command=command, result=result).inc()
+
+    def _record_commands(self, results:list[dict], seconds:list[float]):
+        for r, s in zip(results, seconds):
+            self._record_command(r['in'], s, r['return_code']['name'])
+
+    def _recv(self):
+        try:
+            return self._conn.recv()
+        except EOFError:
+            raise RuntimeError(f'CSH context {self.name} exited (code {self._process.poll()})')
+
+    def _call(self, op:str, payload):
+        with self.lock:
+            self._conn.send((op, payload))
+            status, result = self._recv()
+        if status == 'error':
+            raise RuntimeError(f'CSH context {self.name}: {result}')
+        return result
+
+    def execute(self, cmd:str) -> tuple[bytes, SLASH_RETURN]:
+        t0 = time.perf_counter()
+        out, res, seconds = self._call('execute', cmd)
+        self._record_command(cmd, seconds, res.name)
+        registry.histogram('csh_context_command_seconds', context=self.name, command=command_name(cmd)).record(time.perf_counter() - t0)
+        return out, res
+
+    def execute_script(self, cmds:list[str]) -> list[dict]:
+        t0 = time.perf_counter()
+        result, seconds = self._call('script', cmds)
+        self._record_commands(result, seconds)
+        _local.script_seconds = [(r['in'], s) for r, s in zip(result, seconds)]
+        registry.histogram('csh_context_script_seconds', context=self.name).record(time.perf_counter() - t0)
+        return result
+
+    def close(self, timeout=5):
+        if self._process is None:
+            return
+        try:
+            self._call('close', None)
+            self._process.wait(timeout)
+        except (RuntimeError, OSError, subprocess.TimeoutExpired):
+            self._process.kill()
+        finally:
+            self._conn.close()
+            self._process = None
+
+
+class CSHPool:
+    """Independent CSH contexts and the routing of satellites to them
+
+    Args:
+        contexts (dict[str, dict]): context name to configuration, where
+            ``init`` lists the commands setting up its interfaces
+        default (str): context used for unrouted satellites and requests
+        debug (bool): trace the output of every command
+    """
+    contexts: dict[str, CSHContext]
+    routes: dict[str, str]
+
+    def __init__(self, contexts:dict[str, dict], default='default', debug=False):
+        if default not in contexts:
+            raise ValueError(f'Default CSH context {default} is not configured')
+        self.default = default
+        self.routes = dict()
+        self.contexts = {
+            name: CSHContext(name, config.get('init', []), debug=debug)
+            for name,config in contexts.items()
+        }
+
+    def start(self):
+        """Start all contexts in parallel and wait for their init commands to finish"""
+        for context in self.contexts.values():
+            context.start()
+        for context in self.contexts.values():
+            context.wait_ready()
+
+    def load_routes(self, satellites:dict[str, dict]):
+        """Route satellites by their ``csh_context``, defaulting to the default context"""
+        routes = dict()
+        for satellite, config in satellites.items():
+            context = config.get('csh_context', self.default)
+            if context not in self.contexts:
+                trace.warning('Satellite %s routed to unknown CSH context %s, using %s', satellite, context, self.default)
+                context = self.default
+            routes[satellite] = context
+        self.routes = routes
+
+    def context(self, name:str|None=None) -> CSHContext:
+        context = self.contexts.get(name or self.default)
+        if context is None:
+            raise KeyError(f'Unknown CSH context {name}')
+        return context
+
+    def for_satellite(self, satellite:str|None) -> CSHContext:
+        return self.contexts[self.routes.get(satellite, self.default)]
+
+    def close(self):
+        for context in self.contexts.values():
+            context.close()
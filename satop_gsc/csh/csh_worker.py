@@ -0,0 +1,54 @@
+"""Runs a single CSH context in its own process, see csh_pool.CSHContext
+
+    csh_worker.py <connection fd> <json config>
+"""
+import json
+import os
+import sys
+
+# Allow the same flat imports as the rest of the client
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from multiprocessing.connection import Connection
+import tracing
+from csh.csh_wrapper import CSH
+
+def execute_script(csh:CSH, cmds:list[str]) -> tuple[list[dict], list[float]]:
+    """Script results and the seconds each command took, for the metrics kept by the client"""
+    results = []
+    seconds = []
+    for cmd in cmds:
+        results += csh.execute_script([cmd])
+        seconds.append(csh.last_seconds)
+    return results, seconds
+
+def main(fd:int, config:dict):
+    if config.get('tracing'):
+        tracing.configure(**config['tracing'])
+    conn = Connection(fd)
+
+    csh = CSH(config['slash_linewidth'], config['slash_history'], debug=config['debug'])
+    conn.send(('ready', execute_script(csh, config['init'])))
+
+    while True:
+        try:
+            op, payload = conn.recv()
+        except EOFError:
+            break
+        try:
+            match op:
+                case 'execute':
+                    out, res = csh.execute(payload)
+                    conn.send(('ok', (out, res, csh.last_seconds)))
+                case 'script':
+                    conn.send(('ok', execute_script(csh, payload)))
+                case 'close':
+                    conn.send(('ok', None))
+                    break
+                case _:
+                    conn.send(('error', f'Unknown operation {op}'))
+        except Exception as e:
+            conn.send(('error', f'{type(e).__name__}: {e}'))
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]), json.loads(sys.argv[2]))
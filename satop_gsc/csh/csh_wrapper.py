@@ -1,8 +1,13 @@
 import ctypes
 import enum
+import logging
 import os
 import select
 import sys
+import time
+from tracing import Summary, get_tracer
+
+trace = get_tracer('csh')
 
 """
 /* Command return values */
@@ -111,10 +116,12 @@ struct slash {
 
 """
 
-slashlib = ctypes.CDLL(os.path.join(
+# SATOP_GSC_LIBCSH allows loading another build of the slash library,
+# e.g. the stub used by the benchmarks
+slashlib = ctypes.CDLL(os.environ.get('SATOP_GSC_LIBCSH', os.path.join(
     os.path.dirname(os.path.realpath(__file__)),
     'libcsh.so'
-))
+)))
 libc = ctypes.CDLL(None)
 
 
@@ -213,10 +220,12 @@ class CSH:
     def __init__(self, slash_linewidth=64, slash_history=1024, debug=False):
         self.slash = slashlib.slash_create(slash_linewidth, slash_history)
         self.debug = debug
+        # Seconds the last command took to execute
+        self.last_seconds = 0.0
     
     def execute(self, cmd):
         if self.debug:
-            print(f'csh < {cmd}')
+            trace.debug('csh < %s', cmd)
         pipe_out, pipe_in = os.pipe()
         stdout_fileno = sys.stdout.fileno() # doesn't work in jupyter, where stdout is 39
 
@@ -225,7 +234,9 @@ class CSH:
         # Replace stdout with our write pipe
         os.dup2(pipe_in, stdout_fileno)
 
+        t0 = time.perf_counter()
         res = slashlib.slash_execute(self.slash, cmd.encode('utf-8'))
+        self.last_seconds = time.perf_counter() - t0
         res = SLASH_RETURN(res)
 
         libc.fflush(None)
@@ -240,10 +251,10 @@ class CSH:
         os.close(pipe_in)
         os.close(pipe_out)
         os.dup2(stdout, stdout_fileno)
+        os.close(stdout)
 
-        if self.debug:
-            for l in out.split(b'\n'):
-                print(f'csh > {l.decode()}')
+        if self.debug and trace.isEnabledFor(logging.DEBUG):
+            trace.debug('csh > %s', Summary(out.decode(errors='replace')))
 
         return out, res
     
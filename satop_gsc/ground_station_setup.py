@@ -4,10 +4,22 @@ __location =  {
     'elevation': 60
 }
 
+# CSH contexts run in parallel, each in its own process. 'init' sets up the
+# interfaces of the context, e.g. 'csp add zmq ...' or 'csp add can ...'
+__csh_contexts = {
+    'default': {
+        'init': [
+            'csp init -m "CSH Client"',
+            'ident'
+        ]
+    }
+}
+
 __satellites = {
     'DISCO-1': {
         'tx': True,
         'rx': True,
+        'csh_context': 'default',
         'tle': [
             "1 56222U 23054AW  24353.67685951  .00225592  00000+0  13568-2 0  9994",
             "2 56222  97.3318 255.2963 0005670 125.2407 234.9391 15.77072259 94741"
@@ -19,4 +31,34 @@ def get_gs_location():
     return __location
 
 def get_available_sattelites():
-    return __satellites
\ No newline at end of file
+    return __satellites
+
+def get_csh_contexts():
+    return __csh_contexts
+
+__change_listeners = []
+
+def add_change_listener(callback):
+    """Call ``callback()`` whenever the station location or the satellite catalog changes"""
+    __change_listeners.append(callback)
+
+def __notify_change():
+    for callback in __change_listeners:
+        callback()
+
+def set_gs_location(latitude:float, longitude:float, elevation:float):
+    __location.update(latitude=latitude, longitude=longitude, elevation=elevation)
+    __notify_change()
+
+def set_satellite(name:str, tle:list[str], tx=True, rx=True, csh_context='default'):
+    __satellites[name] = {
+        'tx': tx,
+        'rx': rx,
+        'csh_context': csh_context,
+        'tle': tle
+    }
+    __notify_change()
+
+def remove_satellite(name:str):
+    if __satellites.pop(name, None) is not None:
+        __notify_change()
@@ -1,30 +1,87 @@
 import argparse
 import asyncio
-import dataclasses
 import datetime
 
 import json
+from pathlib import Path
 from uuid import uuid4
 from websockets import Data
-from satop_client import SatopClient
+from admission import Admission
+from satop_client import FramedResponse, SatopClient
 
-from csh.csh_wrapper import CSH
-from ground_station_setup import get_available_sattelites, get_gs_location
-from observations import get_passes
+from csh.csh_pool import CSHPool, take_script_seconds
+from ground_station_setup import add_change_listener, get_available_sattelites, get_csh_contexts, get_gs_location
+from observations import PassHorizon, PassTable
 from scheduler import CSHScheduler
+from telemetry import TelemetryStore, to_records
 from satop_api import SatopApi
+from metrics import registry
+from profiling import Profiler
+from response_cache import CachePolicy
+import tracing
+from tracing import Summary
+
+TRACE_LEVELS = ('debug', 'info', 'warning', 'error', 'critical', 'off')
+
+def trace_level_arg(value:str) -> str:
+    try:
+        tracing.parse_level(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'unknown trace level {value!r}, valid levels are {", ".join(TRACE_LEVELS)}')
+    return value
+
+def subsystem_level_arg(value:str) -> tuple[str, str]:
+    subsystem, sep, level = value.partition('=')
+    if not sep or subsystem not in tracing.SUBSYSTEMS:
+        raise argparse.ArgumentTypeError(f'expected SUBSYSTEM=LEVEL, got {value!r}; subsystems are {", ".join(tracing.SUBSYSTEMS)} '
+                                         f'and levels are {", ".join(TRACE_LEVELS)}')
+    return subsystem, trace_level_arg(level)
+
+def admission_arg(value:str) -> tuple[str, Admission|None]:
+    message_type, sep, limits = value.partition('=')
+    concurrency, _, queue = limits.partition(':')
+    try:
+        concurrency, queue = int(concurrency), int(queue or 16)
+    except ValueError:
+        concurrency = queue = -1
+    if not message_type or not sep or concurrency < 0 or queue < 0:
+        raise argparse.ArgumentTypeError(f'expected TYPE=CONCURRENCY[:QUEUE] with non-negative integers, got {value!r}')
+    return message_type, Admission(concurrency, queue) if concurrency > 0 else None
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--host', default='localhost')
 parser.add_argument('--port', type=int, default=7890)
 parser.add_argument('--https', type=bool, default=False)
+parser.add_argument('--metrics-port', type=int, default=None, help='Serve Prometheus metrics on this port')
+parser.add_argument('--log-level', type=trace_level_arg, default='info', help='Trace level for all subsystems (debug, info, warning, error, off)')
+parser.add_argument('--trace', nargs='*', type=subsystem_level_arg, default=[], metavar='SUBSYSTEM=LEVEL',
+                    help=f'Per-subsystem trace levels, subsystems are {", ".join(tracing.SUBSYSTEMS)}')
+parser.add_argument('--trace-max-length', type=int, default=200, help='Truncate traced payloads to this many characters')
+parser.add_argument('--pass-horizon-days', type=float, default=7, help='Days of upcoming passes kept precomputed')
+parser.add_argument('--pass-horizon-interval', type=float, default=60, help='Seconds between extending the pass horizon')
+parser.add_argument('--telemetry-file', type=Path, default=Path(__file__).parent.resolve() / '.telemetry',
+                    help='File of the telemetry ring buffer')
+parser.add_argument('--telemetry-capacity', type=int, default=100000, help='Telemetry samples kept')
+parser.add_argument('--admission', nargs='*', type=admission_arg, default=[], metavar='TYPE=CONCURRENCY[:QUEUE]',
+                    help='Concurrency limit and queue bound of a message type, a concurrency of 0 runs it in the event loop')
+parser.add_argument('--pause-after', type=float, default=1.0, help='Pause reading requests after a queue has been full this many seconds')
 
 args = parser.parse_args()
 
-client = SatopClient(args.host, args.port)
+tracing.configure(args.log_level, dict(args.trace), args.trace_max_length)
+trace = tracing.get_tracer('station')
+
+client = SatopClient(args.host, args.port, pause_after=args.pause_after)
 api = SatopApi(client.id, args.host, args.port, https=args.https)
-csh = CSH(debug=True)
-scheduler = CSHScheduler(csh, api)
+csh_pool = CSHPool(get_csh_contexts(), debug=True)
+csh_pool.load_routes(get_available_sattelites())
+telemetry = TelemetryStore(args.telemetry_file, args.telemetry_capacity)
+scheduler = CSHScheduler(csh_pool, api, telemetry)
+profiler = Profiler(api)
+horizon = PassHorizon(args.pass_horizon_days, args.pass_horizon_interval)
+client.profiler = profiler
+add_change_listener(client.invalidate_cache)
+add_change_listener(lambda: csh_pool.load_routes(get_available_sattelites()))
 
 
 @client.add_responder('echo')
@@ -32,32 +89,132 @@ def echo_responder(data:dict):
     api.log_received_echo(data)
     return data
 
-@client.add_responder('csh')
+@client.add_responder('metrics')
+def metrics_responder():
+    return registry.snapshot()
+
+@client.add_responder('profile_start')
+def profile_start_responder(mode='cprofile', interval=0.005):
+    profiler.start(mode, interval)
+    return {}
+
+@client.add_responder('profile_stop')
+def profile_stop_responder():
+    return profiler.stop()
+
+@client.add_responder('profile_requests')
+def profile_requests_responder(message_type, count=1):
+    if message_type not in client.responders:
+        raise ValueError(f'Cannot profile {message_type}, it is not a message type')
+    if not isinstance(count, int) or isinstance(count, bool) or count < 1:
+        raise ValueError(f'count must be a positive integer, got {count!r}')
+    profiler.profile_requests(message_type, count)
+    return {}
+
+# Runs csh or get_observations, so it is kept off the event loop as well
+@client.add_responder('profile_call', admission=Admission(concurrency=1, queue=0))
+def profile_call_responder(message_type, arguments=None):
+    if message_type not in ('csh', 'get_observations'):
+        raise ValueError(f'Cannot profile {message_type}, only csh and get_observations')
+    func = client.responders[message_type]
+    details = None
+    if message_type == 'csh':
+        # CSH runs in a worker process, where the profile can't see it
+        take_script_seconds()
+        def details():
+            lines = [f'{seconds * 1000:12.3f} ms  {cmd}' for cmd, seconds in take_script_seconds()]
+            return 'CSH commands, executed in the worker process:\n' + '\n'.join(lines) + '\n'
+    return profiler.profile_call(message_type, func, client.bind_args(func, arguments or dict(), [], None), details)
+
+@client.add_responder('csh', admission=Admission(concurrency=len(csh_pool.contexts), queue=16))
 def csh_responder(data:dict):
     script = data.get('script', [])
+    if 'context' in data:
+        context = csh_pool.context(data['context'])
+    else:
+        context = csh_pool.for_satellite(data.get('satellite'))
     _, artifact_sha1 = api.log_received_commands(script)
     api.log_executed_commands_start(artifact_sha1)
-    res = csh.execute_script(script)
+    res = context.execute_script(script)
+    telemetry.ingest(res)
     api.log_executed_commands_finish(artifact_sha1, res)
     return res
 
-@client.add_responder('station_details')
+@client.add_responder('telemetry')
+def telemetry_responder(name=None, node=None, start=None, end=None, latest=False, limit=1000):
+    """Stored telemetry samples, parsed from the output of earlier CSH commands
+
+    ``start`` and ``end`` are ISO timestamps, in UTC unless they have an
+    offset, ``name`` a parameter name or a list of them (pings are named
+    'ping') and ``latest`` selects only the newest sample of each parameter
+    and node.
+    """
+    def timestamp(value):
+        t = datetime.datetime.fromisoformat(value)
+        if t.tzinfo is None:
+            t = t.replace(tzinfo=datetime.timezone.utc)
+        return t.timestamp()
+
+    def is_int(value):
+        return isinstance(value, int) and not isinstance(value, bool)
+
+    try:
+        start = timestamp(start) if start else None
+        end = timestamp(end) if end else None
+        if node is not None and not is_int(node):
+            raise ValueError(f'node must be an integer, got {node!r}')
+        if limit is not None and not (is_int(limit) and limit >= 0):
+            raise ValueError(f'limit must be a non-negative integer, got {limit!r}')
+        if name is not None and not (isinstance(name, str) or isinstance(name, list) and all(isinstance(n, str) for n in name)):
+            raise ValueError(f'name must be a parameter name or a list of them, got {name!r}')
+    except (TypeError, ValueError) as e:
+        return {
+            'error': {
+                'status': 400,
+                'detail': f'Invalid query: {e}'
+            }
+        }
+    samples = telemetry.query(name, node, start, end, latest, limit)
+    return {'samples': to_records(samples)}
+
+@client.add_responder('station_details', cache=CachePolicy(ttl=300))
 def sdr():
     satellites = get_available_sattelites()
     location = get_gs_location()
-    print('Getting station details')
+    trace.debug('Getting station details')
     return {
         'location': location,
         'satellites': list(satellites.keys())
     }
 
-@client.add_responder('get_observations')
-def observe_responder(satellite, min_degree=30, delta_days=7):
-    return {
-        'observations': list(map(lambda o: dataclasses.asdict(o), get_passes(satellite, min_degree, delta_days)))
-    }
+# Passes are answered from the pass horizon, or searched when outside of it.
+# Cached responses may include a pass that started less than a TTL ago
+@client.add_responder('get_observations', cache=CachePolicy(ttl=60), admission=Admission(concurrency=2, queue=16))
+def observe_responder(satellite, min_degree=30, delta_days=7, format='records'):
+    """Passes of a satellite
 
-@client.add_responder('schedule_transmission')
+    ``format`` selects the representation of the passes: 'records' (a list
+    of objects with ISO timestamps), 'columns' (a list per field with unix
+    timestamps) or 'binary' (one frame of float64 columns, see PassTable.to_bytes).
+    """
+    passes = horizon.get_passes(satellite, min_degree, delta_days)
+    match format:
+        case 'records':
+            return {'observations': passes.to_records()}
+        case 'columns':
+            return {'observations': passes.to_columns()}
+        case 'binary':
+            return FramedResponse({
+                'observations': {
+                    'fields': PassTable.FIELDS,
+                    'dtype': '<f8',
+                    'count': len(passes)
+                }
+            }, [passes.to_bytes()])
+        case _:
+            raise ValueError(f'Unknown format {format}')
+
+@client.add_responder('schedule_transmission', admission=Admission(concurrency=2, queue=64))
 def schedule(time, satellite, dataframes: list[Data]):
     dtime = datetime.datetime.fromisoformat(time)
     satellites = get_available_sattelites()
@@ -84,29 +241,105 @@ def schedule(time, satellite, dataframes: list[Data]):
             }
         }
     data = json.loads(dataframes[0])
-    print(f'Schedule for transmission at {dtime}')
-    print(data)
-    scheduler.add(start_time=dtime, commands=data, id=uuid4().hex)
+    trace.info('Schedule for transmission at %s: %s', dtime, Summary(data))
+    scheduler.add(start_time=dtime, commands=data, id=uuid4().hex, satellite=satellite)
     return {}
+
+@client.add_responder('schedule_transmissions', admission=Admission(concurrency=1, queue=8))
+def schedule_many(dataframes: list[Data], entries=None):
+    """Schedule many scripts in one request
+
+    Each entry is ``{'time': ..., 'satellite': ..., 'frame': n}``, where
+    ``frame`` is the index of the data frame holding its script, so entries
+    can share a frame. Either all entries are scheduled or none are, and
+    ``results`` holds the script id or the error of each entry.
+    """
+    if not isinstance(entries, list) or not entries:
+        return {
+            'error': {
+                'status': 400,
+                'detail': 'entries must be a non-empty list'
+            }
+        }
+    satellites = get_available_sattelites()
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    scripts = {}
+    results = []
+    valid = []
+    for entry in entries:
+        try:
+            dtime = datetime.datetime.fromisoformat(entry['time'])
+            satellite = entry['satellite']
+            frame = entry['frame']
+            if not isinstance(frame, int) or isinstance(frame, bool) or frame < 0:
+                raise ValueError(f'frame must be a frame index, got {frame}')
+            if not satellite in satellites:
+                results.append({'error': {'status': 404, 'detail': 'satellite not found'}})
+                continue
+            if dtime < now:
+                results.append({'error': {'status': 400, 'detail': 'Cannot schedule event in the past'}})
+                continue
+            if frame not in scripts:
+                script = json.loads(dataframes[frame])
+                if not isinstance(script, list) or not all(isinstance(cmd, str) for cmd in script):
+                    raise ValueError(f'frame {frame} is not a list of commands')
+                scripts[frame] = script
+        except (KeyError, IndexError, TypeError, ValueError) as e:
+            results.append({'error': {'status': 400, 'detail': f'Invalid entry: {e}'}})
+            continue
+        id = uuid4().hex
+        valid.append((dtime, scripts[frame], id, satellite))
+        results.append({'id': id})
+
+    if len(valid) < len(entries):
+        results = [r if 'error' in r else {'error': {'status': 409, 'detail': 'Not scheduled, other entries are invalid'}}
+                   for r in results]
+        return {
+            'error': {
+                'status': 400,
+                'detail': f'{len(entries) - len(valid)} of {len(entries)} entries are invalid, nothing was scheduled'
+            },
+            'results': results
+        }
+
+    trace.info('Schedule %s transmissions using %s scripts', len(valid), len(scripts))
+    scheduler.add_many(valid)
+    return {'results': results}
         
 
 
 @client.add_responder('test_frames')
-def observe_responder(dframes:list[str|bytes]):
-    print(f'Recieved {len(dframes)} frames')
+def test_frames_responder(dframes:list[str|bytes]):
+    trace.info('Recieved %s frames', len(dframes))
     for n,frame in enumerate(dframes):
-        print(f' Frame {n}, {type(frame)}, {len(frame)}')
+        trace.info(' Frame %s, %s, %s', n, type(frame), len(frame))
     return {}
 
+for message_type, admission in args.admission:
+    if message_type not in client.responders:
+        parser.error(f'argument --admission: unknown message type {message_type!r}, '
+                     f'message types are {", ".join(client.responders)}')
+    client.set_admission(message_type, admission)
+
 
 async def main():
-    await client.connect()
-    print('Connected')
+    if args.metrics_port is not None:
+        registry.serve_prometheus(args.metrics_port)
+        trace.info('Serving metrics on port %s', args.metrics_port)
+
+    # Runs the init commands of every context, e.g. 'csp init'
+    csh_pool.start()
+    horizon_task = asyncio.create_task(horizon.run())
 
-    csh.execute('csp init -m "CSH Client"')
-    csh.execute('ident')
+    try:
+        await client.connect()
+        trace.info('Connected')
 
-    await client.run()
+        await client.run()
+    finally:
+        horizon_task.cancel()
+        csh_pool.close()
+        telemetry.close()
 
     return
 
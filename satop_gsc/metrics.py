@@ -0,0 +1,187 @@
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LabelKey = tuple[tuple[str, str], ...]
+
+def _escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Histogram:
+    """Log-linear histogram in the spirit of HDR histograms
+
+    Values are recorded in seconds and stored as whole microseconds in
+    buckets that are exact below ``2**significant_bits`` µs and above that
+    split every power of two into ``2**(significant_bits-1)`` sub-buckets,
+    giving a relative error of at most ``2**-(significant_bits-1)``.
+    Only used buckets are stored.
+    """
+    QUANTILES = (0.5, 0.9, 0.99)
+
+    def __init__(self, significant_bits=5):
+        self._bits = significant_bits
+        self._half = 1 << (significant_bits - 1)
+        self._buckets: dict[int, int] = dict()
+        self._lock = threading.Lock()
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def _index(self, us:int) -> int:
+        shift = us.bit_length() - self._bits
+        if shift <= 0:
+            return us
+        return shift * self._half + (us >> shift)
+
+    def _bucket_bounds(self, index:int) -> tuple[int, int]:
+        if index < 2 * self._half:
+            return index, index
+        shift = index // self._half - 1
+        mantissa = index - shift * self._half
+        return mantissa << shift, ((mantissa + 1) << shift) - 1
+
+    def record(self, seconds:float):
+        if seconds < 0:
+            seconds = 0.0
+        index = self._index(int(seconds * 1_000_000))
+        with self._lock:
+            self._buckets[index] = self._buckets.get(index, 0) + 1
+            self.count += 1
+            self.sum += seconds
+            if seconds < self.min:
+                self.min = seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def quantile(self, q:float) -> float:
+        """Approximate value (in seconds) below which a fraction ``q`` of the recordings fall"""
+        with self._lock:
+            if not self.count:
+                return math.nan
+            rank = q * self.count
+            seen = 0
+            for index in sorted(self._buckets):
+                seen += self._buckets[index]
+                if seen >= rank:
+                    low, high = self._bucket_bounds(index)
+                    return min((low + high) / 2 / 1_000_000, self.max)
+            return self.max
+
+    def summary(self) -> dict:
+        summary = {
+            'count': self.count,
+            'sum': self.sum,
+            'min': self.min if self.count else None,
+            'max': self.max if self.count else None,
+        }
+        for q in self.QUANTILES:
+            summary[f'p{round(q*100)}'] = self.quantile(q) if self.count else None
+        return summary
+
+
+class MetricsRegistry:
+    """Counters and histograms, keyed by name and labels
+
+    Instruments are created on first use, so call sites can simply do
+    ``registry.histogram('name', label='x').record(seconds)``.
+    """
+
+    def __init__(self):
+        self._counters: dict[str, dict[LabelKey, Counter]] = dict()
+        self._histograms: dict[str, dict[LabelKey, Histogram]] = dict()
+        self._lock = threading.Lock()
+
+    def _get(self, family:dict, name:str, labels:dict, factory):
+        key = tuple(sorted((k, str(v)) for k,v in labels.items()))
+        instruments = family.get(name)
+        if instruments is not None:
+            instrument = instruments.get(key)
+            if instrument is not None:
+                return instrument
+        with self._lock:
+            return family.setdefault(name, dict()).setdefault(key, factory())
+
+    def counter(self, name:str, **labels) -> Counter:
+        return self._get(self._counters, name, labels, Counter)
+
+    def histogram(self, name:str, **labels) -> Histogram:
+        return self._get(self._histograms, name, labels, Histogram)
+
+    def snapshot(self) -> dict:
+        """JSON serializable view of all metrics, as returned by the ``metrics`` responder"""
+        with self._lock:
+            counters = {name: dict(instruments) for name,instruments in self._counters.items()}
+            histograms = {name: dict(instruments) for name,instruments in self._histograms.items()}
+        return {
+            'counters': {
+                name: [{'labels': dict(key), 'value': c.value} for key,c in instruments.items()]
+                for name,instruments in counters.items()
+            },
+            'histograms': {
+                name: [{'labels': dict(key), **h.summary()} for key,h in instruments.items()]
+                for name,instruments in histograms.items()
+            },
+        }
+
+    def prometheus_text(self) -> str:
+        """Metrics in the Prometheus text exposition format; histograms are exported as summaries"""
+        def fmt_labels(key:LabelKey, extra:dict|None=None):
+            pairs = list(key) + list((extra or dict()).items())
+            if not pairs:
+                return ''
+            return '{' + ','.join(f'{k}="{_escape_label(v)}"' for k,v in pairs) + '}'
+
+        snapshot = self.snapshot()
+        lines = []
+        for name, series in snapshot['counters'].items():
+            lines.append(f'# TYPE {name} counter')
+            for s in series:
+                lines.append(f'{name}{fmt_labels(tuple(s["labels"].items()))} {s["value"]}')
+        for name, series in snapshot['histograms'].items():
+            lines.append(f'# TYPE {name} summary')
+            for s in series:
+                key = tuple(s['labels'].items())
+                for q in Histogram.QUANTILES:
+                    value = s[f'p{round(q*100)}']
+                    lines.append(f'{name}{fmt_labels(key, {"quantile": q})} {"NaN" if value is None else value}')
+                lines.append(f'{name}_sum{fmt_labels(key)} {s["sum"]}')
+                lines.append(f'{name}_count{fmt_labels(key)} {s["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def serve_prometheus(self, port:int, host:str='0.0.0.0') -> ThreadingHTTPServer:
+        """Serve ``/metrics`` in the Prometheus text format from a background thread"""
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.prometheus_text().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+registry = MetricsRegistry()
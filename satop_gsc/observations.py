@@ -1,82 +1,235 @@
+import asyncio
 import dataclasses
+import datetime
+import time
 from datetime import timedelta
+import numpy as np
 from skyfield.api import load, EarthSatellite, wgs84, Time
 from ground_station_setup import get_available_sattelites, get_gs_location
+from metrics import registry
+from tracing import get_tracer
 
+trace = get_tracer('station')
 
-@dataclasses.dataclass
-class Observation:
-    rise: Time = None
-    set: Time = None
-    culmination: Time = None
-    duration: int = None
-    max_angle: float = None
-
-    def add_event(self, t:Time, e):
-        match e:
-            case 0:
-                self.rise = t
-            case 1:
-                self.culmination = t
-            case 2:
-                self.set = t
-                if self.rise is None or self.culmination is None:
-                    return -1
-        return e
-    
-    def evaluate(self, gs, sat):
-        assert self.rise is not None
-        assert self.culmination is not None
-        assert self.set is not None
-
-        self.duration = self.set.utc_datetime() - self.rise.utc_datetime()
-
-        difference = sat-gs
-        alt, az, dist = difference.at(self.culmination).altaz()
-
-        self.max_angle = alt.degrees
-    
-    def flatten(self):
-        self.rise = self.rise.utc_iso()
-        self.culmination = self.culmination.utc_iso()
-        self.set = self.set.utc_iso()
-        self.duration = self.duration.seconds
-        self.max_angle = float(self.max_angle)
-
-
-def get_passes(satellite_name: str, min_degrees=30, delta_days=7): 
+ts = load.timescale()
+
+class PassTable:
+    """Passes of a satellite over the ground station as a struct of arrays
+
+    Epochs are UTC unix timestamps (float64), durations are in seconds and
+    ``max_angle`` is the elevation at culmination in degrees. Tables are
+    filtered with boolean masks, e.g. ``table[table.max_angle > 30]``.
+    """
+    FIELDS = ('rise', 'culmination', 'set', 'duration', 'max_angle')
+
+    def __init__(self, rise:np.ndarray, culmination:np.ndarray, set:np.ndarray, max_angle:np.ndarray):
+        self.rise = np.asarray(rise, dtype=np.float64)
+        self.culmination = np.asarray(culmination, dtype=np.float64)
+        self.set = np.asarray(set, dtype=np.float64)
+        self.max_angle = np.asarray(max_angle, dtype=np.float64)
+
+    @property
+    def duration(self) -> np.ndarray:
+        return self.set - self.rise
+
+    @classmethod
+    def empty(cls):
+        e = np.empty(0)
+        return cls(e, e, e, e)
+
+    def __len__(self):
+        return len(self.rise)
+
+    def __getitem__(self, mask) -> 'PassTable':
+        return PassTable(self.rise[mask], self.culmination[mask], self.set[mask], self.max_angle[mask])
+
+    def above(self, min_degrees:float) -> 'PassTable':
+        return self[self.max_angle > min_degrees]
+
+    def concat(self, other:'PassTable') -> 'PassTable':
+        return PassTable(*(np.concatenate((getattr(self, f), getattr(other, f))) for f in ('rise', 'culmination', 'set', 'max_angle')))
+
+    @staticmethod
+    def _iso(epochs:np.ndarray) -> np.ndarray:
+        # Same format as skyfield's Time.utc_iso(), rounded to whole seconds
+        return np.char.add(np.datetime_as_string(np.round(epochs).astype('datetime64[s]'), unit='s'), 'Z')
+
+    def to_records(self) -> list[dict]:
+        """One dict per pass, with ISO timestamps and whole second durations"""
+        return [
+            {'rise': r, 'set': s, 'culmination': c, 'duration': d, 'max_angle': a}
+            for r, s, c, d, a in zip(
+                self._iso(self.rise).tolist(),
+                self._iso(self.set).tolist(),
+                self._iso(self.culmination).tolist(),
+                self.duration.astype(np.int64).tolist(),
+                self.max_angle.tolist()
+            )
+        ]
+
+    def to_columns(self) -> dict[str, list]:
+        """Columnar JSON, one list per field, with epochs as unix timestamps"""
+        return {f: getattr(self, f).tolist() for f in self.FIELDS}
+
+    def to_bytes(self) -> bytes:
+        """Little endian float64 columns in the order of ``FIELDS``, one after the other"""
+        return np.stack([getattr(self, f) for f in self.FIELDS]).astype('<f8').tobytes()
+
+    @classmethod
+    def from_bytes(cls, data:bytes) -> 'PassTable':
+        columns = np.frombuffer(data, dtype='<f8').reshape(len(cls.FIELDS), -1)
+        rise, culmination, set, _, max_angle = columns
+        return cls(rise, culmination, set, max_angle)
+
+
+def compute_passes(satellite:EarthSatellite, gs, t0:Time, t1:Time) -> PassTable:
+    """All complete passes (rise, culmination and set) between t0 and t1"""
+    t, events = satellite.find_events(gs, t0, t1)
+    if len(events) == 0:
+        return PassTable.empty()
+
+    # A pass is a set preceded by a rise, with no set in between, and a
+    # culmination after the rise. Passes cut by the window are skipped.
+    idx = np.arange(len(events))
+    last_rise = np.maximum.accumulate(np.where(events == 0, idx, -1))
+    last_culmination = np.maximum.accumulate(np.where(events == 1, idx, -1))
+    last_set = np.maximum.accumulate(np.where(events == 2, idx, -1))
+    sets = idx[events == 2]
+    previous_set = np.concatenate(([-1], last_set[:-1]))[sets]
+    rises = last_rise[sets]
+    culminations = last_culmination[sets]
+    complete = (rises > previous_set) & (culminations > rises)
+    rises, culminations, sets = rises[complete], culminations[complete], sets[complete]
+    if len(sets) == 0:
+        return PassTable.empty()
+
+    alt, _, _ = (satellite - gs).at(t[culminations]).altaz()
+
+    # Unix timestamps relative to t0, leap seconds within the window are ignored
+    t0_unix = t0.utc_datetime().timestamp()
+    def epochs(i):
+        return t0_unix + (t.tt[i] - t0.tt) * 86400.0
+
+    return PassTable(epochs(rises), epochs(culminations), epochs(sets), alt.degrees)
+
+def _unix_time(epoch:float) -> Time:
+    return ts.from_datetime(datetime.datetime.fromtimestamp(epoch, datetime.timezone.utc))
+
+def get_passes(satellite_name: str, min_degrees=30, delta_days=7) -> PassTable:
     satellites = get_available_sattelites()
     location = get_gs_location()
 
     sat = satellites.get(satellite_name)
     if not sat:
-        return []
-    
+        return PassTable.empty()
+
     gs = wgs84.latlon(location['latitude'], location['longitude'])
-    ts = load.timescale()
-    t0 = ts.now()
-    t1 = ts.now()+timedelta(days=delta_days)
+    t0 = ts.from_datetime(datetime.datetime.now(datetime.timezone.utc))
+    t1 = t0+timedelta(days=delta_days)
 
     satellite = EarthSatellite(*sat.get('tle'), satellite_name, ts)
 
-    observations = []
-    current_observation = Observation()
+    return compute_passes(satellite, gs, t0, t1).above(min_degrees)
 
-    t, events = satellite.find_events(gs, t0, t1)
-    for ti, event in zip(t, events):
-        added = current_observation.add_event(ti, event)
-        if added == 2:
-            current_observation.evaluate(gs, satellite)
-            current_observation.flatten()
-            observations.append(current_observation)
-            current_observation = Observation()
-        elif added == -1:
-            current_observation = Observation()
-    
-    return list(filter(lambda o: o.max_angle > min_degrees, observations))
+
+@dataclasses.dataclass(frozen=True)
+class _Horizon:
+    key: tuple
+    passes: PassTable
+    # Every complete pass setting before ``until`` is known
+    until: float
+    last_set: float
+
+class PassHorizon:
+    """Rolling window of upcoming passes of every satellite
+
+    :meth:`refresh` only searches the part of the window that is new since
+    the last refresh and drops passes that have ended; a satellite is only
+    searched from scratch when its TLE or the station location changes.
+    Queries are answered from the precomputed passes.
+
+    Args:
+        days (float): length of the window
+        interval (float): seconds between refreshes in :meth:`run`. The
+            window reaches two intervals further, so it still covers ``days``
+            until the next refresh
+        max_pass (float): seconds of the longest pass, passes cut by the end
+            of the window are searched again from this far back
+    """
+    horizons: dict[str, _Horizon]
+
+    def __init__(self, days=7, interval=60, max_pass=1800):
+        self.days = days
+        self.interval = interval
+        self.max_pass = max_pass
+        self.horizons = dict()
+
+    @staticmethod
+    def _key(sat:dict, location:dict) -> tuple:
+        return (tuple(sat.get('tle')), location['latitude'], location['longitude'])
+
+    def refresh(self, now:float|None=None):
+        """Extend the window of every satellite to ``now`` plus ``days``"""
+        now = time.time() if now is None else now
+        end = now + self.days * 86400 + 2 * self.interval
+        location = get_gs_location()
+        gs = wgs84.latlon(location['latitude'], location['longitude'])
+
+        horizons = dict()
+        for name, sat in list(get_available_sattelites().items()):
+            key = self._key(sat, location)
+            horizon = self.horizons.get(name)
+            if horizon is None or horizon.key != key:
+                trace.info('Searching passes of %s for %s days', name, self.days)
+                start, passes, last_set = now, PassTable.empty(), now
+            else:
+                passes, last_set = horizon.passes, horizon.last_set
+                start = max(last_set, horizon.until - self.max_pass, now)
+            passes = passes[passes.set >= now]
+
+            if end > start:
+                t0 = time.perf_counter()
+                satellite = EarthSatellite(*sat.get('tle'), name, ts)
+                new = compute_passes(satellite, gs, _unix_time(start), _unix_time(end))
+                new = new[new.rise > last_set]
+                passes = passes.concat(new)
+                if len(new):
+                    last_set = new.set[-1]
+                registry.histogram('pass_horizon_search_seconds').record(time.perf_counter() - t0)
+            horizons[name] = _Horizon(key, passes, end, last_set)
+        # Replaced as a whole, so queries from other threads see a consistent state
+        self.horizons = horizons
+
+    def passes(self, satellite_name:str, min_degrees=30, delta_days=7, now:float|None=None) -> PassTable|None:
+        """Passes starting within ``delta_days``, or None if they are not all in the window"""
+        now = time.time() if now is None else now
+        end = now + delta_days * 86400
+        horizon = self.horizons.get(satellite_name)
+        sat = get_available_sattelites().get(satellite_name)
+        if horizon is None or sat is None or end > horizon.until or horizon.key != self._key(sat, get_gs_location()):
+            return None
+        p = horizon.passes
+        return p[(p.rise >= now) & (p.set <= end) & (p.max_angle > min_degrees)]
+
+    def get_passes(self, satellite_name:str, min_degrees=30, delta_days=7) -> PassTable:
+        """Same as :func:`get_passes`, answered from the window when it covers the request"""
+        passes = self.passes(satellite_name, min_degrees, delta_days)
+        registry.counter('pass_horizon_requests_total', result='miss' if passes is None else 'hit').inc()
+        if passes is None:
+            return get_passes(satellite_name, min_degrees, delta_days)
+        return passes
+
+    async def run(self):
+        """Refresh every ``interval`` seconds, in a worker thread"""
+        while True:
+            try:
+                await asyncio.to_thread(self.refresh)
+            except Exception:
+                trace.exception('Refreshing the pass horizon failed')
+            await asyncio.sleep(self.interval)
 
 def pp_list(l):
     print('[\n  ', end='')
     for i in l:
         print(i, end='\n  ')
-    print('\r]')
\ No newline at end of file
+    print('\r]')
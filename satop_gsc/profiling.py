@@ -0,0 +1,243 @@
+import cProfile
+import io
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from satop_api import SatopApi
+from tracing import get_tracer
+
+trace = get_tracer('station')
+
+class SamplingProfiler:
+    """Periodically samples the stacks of all threads
+
+    Unlike cProfile, which only sees the thread it was enabled in, this also
+    covers the scheduler's dispatcher thread and the thread each due script
+    runs in, at a much lower overhead.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = 0
+        self.stacks: Counter[tuple[str, ...]] = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+
+    def _run(self):
+        own = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({code.co_filename}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                if ident not in names:
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[tuple(reversed(stack))] += 1
+            self.samples += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def report(self, limit=40) -> str:
+        own_time = Counter()
+        for stack, count in self.stacks.items():
+            own_time[stack[-1]] += count
+
+        out = io.StringIO()
+        out.write(f'{self.samples} samples every {self.interval} s\n\n')
+        out.write('Top functions by samples on top of stack:\n')
+        for func, count in own_time.most_common(limit):
+            out.write(f'{count:8} {count/max(self.samples, 1):7.1%}  {func}\n')
+        # Collapsed stacks, e.g. for flamegraph.pl or speedscope
+        out.write('\nCollapsed stacks:\n')
+        for stack, count in self.stacks.most_common():
+            out.write(f'{";".join(stack)} {count}\n')
+        return out.getvalue()
+
+
+def _cprofile_report(*profiles:cProfile.Profile, limit=40) -> str:
+    out = io.StringIO()
+    pstats.Stats(*profiles, stream=out).sort_stats('cumulative').print_stats(limit)
+    return out.getvalue()
+
+
+class Profiler:
+    """Profiling sessions controlled from the platform, uploaded as artifacts
+
+    Only one session (manual, request based or single call) can run at a time.
+    Responders running in worker threads are profiled with a profile of their
+    own, which is merged into the report of the session.
+    """
+    api: SatopApi
+
+    def __init__(self, api:SatopApi):
+        self.api = api
+        self._lock = threading.Lock()
+        self._mode: str | None = None
+        self._session: cProfile.Profile | SamplingProfiler | None = None
+        self._session_thread: int | None = None
+        self._session_start: float = 0
+        # Profiles of single requests, replaced for every session
+        self._profiles: list[cProfile.Profile] = []
+        self._request_type: str | None = None
+        self._request_remaining = 0
+        self._request_running = 0
+        self._request_wall = 0.0
+
+    def _claim(self, mode:str, session:cProfile.Profile|SamplingProfiler|None=None):
+        with self._lock:
+            if self._mode is not None:
+                raise RuntimeError('A profiling session is already running')
+            self._mode = mode
+            self._session = session
+            self._session_thread = threading.get_ident()
+            self._session_start = time.perf_counter()
+            self._profiles = []
+
+    def _release(self):
+        # Called with self._lock held
+        self._mode = None
+        self._session = None
+        self._request_type = None
+
+    def start(self, mode='cprofile', interval=0.005):
+        """Start a manual session
+
+        Args:
+            mode (str): 'cprofile' to trace the responders, 'sampling' to sample all threads
+            interval (float): seconds between samples in sampling mode
+        """
+        match mode:
+            case 'cprofile':
+                session = cProfile.Profile()
+                self._claim(mode, session)
+                session.enable()
+            case 'sampling':
+                session = SamplingProfiler(interval)
+                self._claim(mode, session)
+                session.start()
+            case _:
+                raise ValueError(f'Unknown profiling mode {mode}')
+        trace.info('Started %s profiling', mode)
+
+    def stop(self) -> dict:
+        """Stop the manual session, or cancel a request based one, and upload its report
+
+        A request based session is reported with the requests profiled so
+        far; requests still running are left out.
+        """
+        with self._lock:
+            mode, session, profiles = self._mode, self._session, list(self._profiles)
+            if mode not in ('cprofile', 'sampling', 'requests'):
+                raise RuntimeError('No manual or request based profiling session is running')
+            wall = time.perf_counter() - self._session_start
+            message_type, request_wall = self._request_type, self._request_wall
+            self._release()
+        if mode == 'requests':
+            trace.info('Cancelled profiling of %s requests after %s requests', message_type, len(profiles))
+            if not profiles:
+                return {'artifact': None, 'wall_seconds': 0.0, 'requests': 0}
+            report = _cprofile_report(*profiles)
+            sha1 = self.api.log_profile(f'{message_type} requests (cancelled), wall time {request_wall:.6f} s\n\n{report}', message_type)
+            return {'artifact': sha1, 'wall_seconds': request_wall, 'requests': len(profiles)}
+        if isinstance(session, SamplingProfiler):
+            session.stop()
+            report = session.report()
+        else:
+            session.disable()
+            report = _cprofile_report(session, *profiles)
+
+        sha1 = self.api.log_profile(f'{mode} session, wall time {wall:.6f} s\n\n{report}', mode)
+        return {'artifact': sha1, 'wall_seconds': wall}
+
+    def profile_requests(self, message_type:str, count=1):
+        """Profile the next ``count`` requests of ``message_type``, uploading the report after the last one"""
+        if count < 1:
+            raise ValueError('count must be at least 1')
+        self._claim('requests')
+        with self._lock:
+            self._request_type = message_type
+            self._request_remaining = count
+            self._request_running = 0
+            self._request_wall = 0.0
+        trace.info('Profiling next %s %s requests', count, message_type)
+
+    def wants(self, message_type:str) -> bool:
+        """Whether requests of ``message_type`` should currently run through :meth:`profile_request`"""
+        return self._mode == 'cprofile' or (self._mode == 'requests' and self._request_type == message_type)
+
+    def profile_request(self, message_type:str, func, args:dict):
+        """Run a responder, profiled if a session selected it"""
+        with self._lock:
+            profiles = self._profiles
+            if self._mode == 'requests' and self._request_type == message_type and self._request_remaining > 0:
+                self._request_remaining -= 1
+                self._request_running += 1
+            elif not (self._mode == 'cprofile' and threading.get_ident() != self._session_thread):
+                # Not selected, or already traced by the session's own profile
+                profiles = None
+        if profiles is None:
+            return func(**args)
+
+        profile = cProfile.Profile()
+        t0 = time.perf_counter()
+        try:
+            result = profile.runcall(func, **args)
+        except BaseException:
+            self._profiled(profiles, message_type, profile, time.perf_counter() - t0)
+            raise
+        self._profiled(profiles, message_type, profile, time.perf_counter() - t0)
+        return result
+
+    def _profiled(self, profiles:list[cProfile.Profile], message_type:str, profile:cProfile.Profile, wall:float):
+        with self._lock:
+            if profiles is not self._profiles or self._mode is None:
+                # The session ended while the request ran
+                return
+            profiles.append(profile)
+            if self._mode != 'requests':
+                return
+            self._request_wall += wall
+            self._request_running -= 1
+            if self._request_remaining or self._request_running:
+                return
+            wall = self._request_wall
+            self._release()
+        try:
+            self.api.log_profile(f'{message_type} requests, wall time {wall:.6f} s\n\n{_cprofile_report(*profiles)}', message_type)
+        except Exception:
+            trace.exception('Uploading the profile of %s requests failed', message_type)
+
+    def profile_call(self, name:str, func, args:dict, details=None) -> dict:
+        """Run ``func`` once and upload a wall-clock breakdown of where its time went
+
+        Args:
+            details (callable): returns text put before the profile in the
+                report, for time spent outside of this process
+        """
+        session = cProfile.Profile()
+        self._claim('call', session)
+        t0 = time.perf_counter()
+        try:
+            session.runcall(func, **args)
+        finally:
+            wall = time.perf_counter() - t0
+            with self._lock:
+                self._release()
+        report = _cprofile_report(session)
+        if details:
+            report = f'{details()}\n{report}'
+        sha1 = self.api.log_profile(f'{name} call, wall time {wall:.6f} s\n\n{report}', name)
+        return {'artifact': sha1, 'wall_seconds': wall}
@@ -0,0 +1,68 @@
+import dataclasses
+import json
+import threading
+import time
+from collections import OrderedDict
+from inspect import signature
+
+@dataclasses.dataclass
+class CachePolicy:
+    """Caching of a responder's serialized responses
+
+    Only use for responders that are pure functions of their bound arguments
+    and the station configuration.
+
+    Args:
+        ttl (float): seconds a response stays valid
+        max_entries (int): distinct argument sets kept, least recently used are evicted first
+    """
+    ttl: float
+    max_entries: int = 128
+
+class ResponseCache:
+    """Bounded LRU of JSON encoded responses keyed by bound arguments"""
+
+    def __init__(self, policy:CachePolicy):
+        self.policy = policy
+        self._entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self._lock = threading.Lock()
+        # Bumped by clear(), so responses computed before it aren't stored
+        self.generation = 0
+
+    @staticmethod
+    def key(func, args:dict) -> str:
+        """Arguments of a call to ``func`` with its defaults filled in
+
+        So a request leaving out an argument shares the entry of one passing
+        its default value.
+        """
+        bound = signature(func).bind(**args)
+        bound.apply_defaults()
+        return json.dumps(bound.arguments, sort_keys=True, default=str)
+
+    def get(self, key:str) -> str | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, serialized = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return serialized
+
+    def put(self, key:str, serialized:str, generation:int|None=None):
+        """Store a response, unless the cache was cleared since ``generation`` was read"""
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries[key] = (time.monotonic() + self.policy.ttl, serialized)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.policy.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.generation += 1
@@ -2,10 +2,15 @@ from io import StringIO
 import requests
 import json
 import datetime
+import time
 from enum import Enum
 from typing import IO, Optional, Union
 from uuid import uuid4, UUID
 from pydantic import BaseModel, Field
+from metrics import registry
+from tracing import Summary, get_tracer
+
+trace = get_tracer('api')
 
 class EntityType(str, Enum):
     user = 'user'
@@ -79,24 +84,35 @@ class SatopApi:
         if self.auth_token:
             headers['Authorization'] = f'Bearer {self.auth_token}'
     
+    def _post(self, endpoint:str, **kwargs) -> requests.Response:
+        t0 = time.perf_counter()
+        try:
+            response = requests.post(self.base_url + endpoint, headers=self._get_headers(), **kwargs)
+        except requests.RequestException:
+            registry.counter('satop_api_request_errors_total', endpoint=endpoint, status='connection').inc()
+            raise
+        finally:
+            registry.histogram('satop_api_request_seconds', endpoint=endpoint).record(time.perf_counter() - t0)
+        if response.status_code >= 400:
+            registry.counter('satop_api_request_errors_total', endpoint=endpoint, status=response.status_code).inc()
+        return response
+
     def _log_new_artifact_raw(self, data:IO[bytes], filename:str|None=None, mime_type='application/octet-stream'):
         if filename is None:
             filename = 'gs_artifact_'+datetime.datetime.now(datetime.timezone.utc).isoformat()
         files = {'file':( filename, data, mime_type )}
-        print(f"uploading artifacts: {files}")
-        response = requests.post(self.base_url + '/log/artifacts', headers=self._get_headers(), files=files)
+        trace.debug('Uploading artifact filename=%s mime_type=%s', filename, mime_type)
+        response = self._post('/log/artifacts', files=files)
 
         if response.status_code == 200:
-            print('Artifact already exists')
+            trace.debug('Artifact already exists')
             return response.json().get('detail').split(' ')[-1]
 
         elif response.status_code != 201: 
-            print(response.status_code)
-            print(response.reason)
-            print(response.content)
+            trace.error('Artifact upload failed: %s %s %s', response.status_code, response.reason, Summary(response.content))
             raise RuntimeError
         
-        print(response.content)
+        trace.debug('Artifact uploaded: %s', Summary(response.content))
         
         result = ArtifactUploadResponse.model_validate_json(response.content)
         return result.sha1
@@ -112,19 +128,20 @@ class SatopApi:
         return self._log_new_artifact_raw(b_data, filename, mime_type='application/json')
 
     def _log_event(self, event:EventBase):
-        response = requests.post(self.base_url+'/log/events', headers=self._get_headers(), json=event.model_dump())
+        response = self._post('/log/events', json=event.model_dump())
 
         if response.status_code != 200:
-            print(response.status_code)
-            print(response.reason)
-            print(response.content)
+            trace.error('Event logging failed: %s %s %s', response.status_code, response.reason, Summary(response.content))
             raise RuntimeError
         
         return Event.model_validate_json(response.content)
 
 
-    def log_received_echo(self, content:str):
-        sha1 = self._log_new_artifact_str(content)
+    def log_received_echo(self, content:str|dict|list):
+        if isinstance(content, str):
+            sha1 = self._log_new_artifact_str(content)
+        else:
+            sha1 = self._log_new_artifact_json(content)
         event = EventBase(descriptor='gsEchoEvent',relationships=[
             self._executed_at_relation,
             EventObjectRelationship(predicate=Predicate(descriptor='echoing'), object=Artifact(sha1=sha1))
@@ -144,6 +161,37 @@ class SatopApi:
             ))
         return self._log_event(event), sha1
 
+    def log_received_commands_batch(self, scripts:list[tuple[list[str], float|None]]):
+        """Log many received scripts with a single event
+
+        Identical scripts are uploaded once and share their artifact. Each
+        scheduled script is related to its execution time by a triple.
+
+        Returns:
+            The logged event and the artifact hash of each script
+        """
+        artifacts: dict[str, str] = dict()
+        relationships = [self._executed_at_relation]
+        for script, _ in scripts:
+            content = '\n'.join(script)
+            if content not in artifacts:
+                artifacts[content] = self._log_new_artifact_str(content)
+                relationships.append(EventObjectRelationship(predicate=Predicate(descriptor='content'), object=Artifact(sha1=artifacts[content])))
+
+        sha1s = []
+        for script, scheduled_at in scripts:
+            sha1 = artifacts['\n'.join(script)]
+            sha1s.append(sha1)
+            if scheduled_at:
+                relationships.append(Triple(
+                    subject=Artifact(sha1=sha1),
+                    predicate=Predicate(descriptor='scheduledExecutionAt'),
+                    object=scheduled_at
+                ))
+
+        event = EventBase(descriptor='gsReceiveCSHBatch', relationships=relationships)
+        return self._log_event(event), sha1s
+
     def log_executed_commands_start(self, script_sha1:str, timing_deltastart:datetime.timedelta=None):
         event = TimestampedEvent(
             descriptor='startedCommandExecution',
@@ -171,3 +219,14 @@ class SatopApi:
             event.relationships.append(EventObjectRelationship(predicate=Predicate(descriptor='executionRuntime'), 
                                                                object=str(timing_runtime)))
         return self._log_event(event)
+
+    def log_profile(self, report:str, profiled:str):
+        timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        sha1 = self._log_new_artifact_str(report, f'gs_profile_{profiled}_{timestamp}.txt')
+        event = EventBase(descriptor='gsProfileCaptured', relationships=[
+            self._executed_at_relation,
+            EventObjectRelationship(predicate=Predicate(descriptor='profiled'), object=profiled),
+            EventObjectRelationship(predicate=Predicate(descriptor='profile'), object=Artifact(sha1=sha1))
+        ])
+        self._log_event(event)
+        return sha1
@@ -1,6 +1,7 @@
 import asyncio
+import dataclasses
 import json
-import traceback
+import time
 import typing
 import websockets
 from inspect import signature
@@ -9,6 +10,15 @@ from uuid import uuid4, UUID
 from websockets.asyncio.client import ClientConnection
 from websockets.typing import Data
 from pathlib import Path
+from metrics import registry
+from admission import Admission, AdmissionQueue
+from response_cache import CachePolicy, ResponseCache
+from tracing import Summary, get_tracer
+
+if typing.TYPE_CHECKING:
+    from profiling import Profiler
+
+trace = get_tracer('client')
 
 def split_origin_args(typ):
     origin = typing.get_origin(typ)
@@ -20,19 +30,35 @@ def split_origin_args(typ):
 
     return origin, args
 
+@dataclasses.dataclass
+class FramedResponse:
+    """Response data followed by binary frames
+
+    Announced with ``frames`` in the response message, the same way
+    requests announce extra frames. Framed responses are never cached.
+    """
+    data: typing.Any
+    frames: list[bytes]
+
 class SatopClient:
     responders: dict[str, callable] = dict()
     ws: ClientConnection
     id: UUID | None = None
+    profiler: 'Profiler | None' = None
 
-    def __init__(self, host, port=80, tls=False, api_path='/api/gs'):
+    def __init__(self, host, port=80, tls=False, api_path='/api/gs', id_file:Path|None=None, pause_after=1.0):
         ws_proto, http_proto = ('wss', 'https') if tls else ('ws', 'http')
 
         base_path = f'{host}:{port}{api_path}'
         self.ws_url = f'{ws_proto}://{base_path}/ws'
         self.gsapi_url = f'{http_proto}://{base_path}'
+        self.caches: dict[str, ResponseCache] = dict()
+        # Requests of types without a queue run one at a time in the event loop
+        self.queues: dict[str, AdmissionQueue] = dict()
+        self.pause_after = pause_after
+        self._send_lock = asyncio.Lock()
 
-        self.id_file = Path(__file__).parent.resolve() / '.id'
+        self.id_file = id_file or Path(__file__).parent.resolve() / '.id'
         if self.id_file.exists():
             with open(self.id_file) as f:
                 self.id = UUID(f.read())
@@ -68,11 +94,66 @@ class SatopClient:
     async def disconnect(self):
         await self.ws.close(1001)
 
-    def add_responder(self, message_type):
+    def add_responder(self, message_type, cache:CachePolicy|None=None, admission:Admission|None=None):
+        """Register the decorated function as responder for a message type
+
+        Args:
+            message_type (str): request type to respond to
+            cache (CachePolicy): cache serialized responses by bound arguments
+            admission (Admission): run in worker threads with limited
+                concurrency and a bounded queue, instead of in the event loop.
+                Use for slow responders, so they don't delay other requests
+        """
         def decorator(func):
             self.responders[message_type] = func
+            if cache:
+                self.caches[message_type] = ResponseCache(cache)
+            else:
+                self.caches.pop(message_type, None)
+            self.set_admission(message_type, admission)
+            return func
         return decorator
+
+    def set_admission(self, message_type, admission:Admission|None):
+        """Change the admission policy of a message type, None to run it in the event loop"""
+        if admission:
+            self.queues[message_type] = AdmissionQueue(admission)
+        else:
+            self.queues.pop(message_type, None)
+
+    def invalidate_cache(self, *message_types:str):
+        """Drop cached responses of the given message types, or of all types if none are given"""
+        for message_type, cache in self.caches.items():
+            if not message_types or message_type in message_types:
+                cache.clear()
     
+    def bind_args(self, func, data:dict, data_frames:list[Data], raw_msg:Data|None) -> dict:
+        """Map a request onto the parameters of a responder
+
+        Parameters named in the request data get that value, otherwise they
+        are bound by annotation: ``list[Data]`` to the extra frames, ``Data``
+        to the raw message and ``dict`` to the request data.
+        """
+        type_hints = { arg: annotation.annotation for arg,annotation in signature(func).parameters.items() }
+        if 'return' in type_hints:
+            # Remove return value annotation
+            type_hints.pop('return')
+        args = {}
+        for arg, hint in type_hints.items():
+            if arg in data:
+                args[arg] = data[arg]
+                continue
+            arg_type, arg_type_args = split_origin_args(hint) # e.g. list[str]  =>  list, (str,)
+            if arg_type == list and arg_type_args == (Data,):
+                args[arg] = data_frames
+            elif arg_type == Data:
+                args[arg] = raw_msg
+            elif arg_type == dict:
+                args[arg] = data
+            else:
+                trace.debug('%s: argument %s not bound (%s)', func.__name__, arg, hint)
+        return args
+
     def error_message(self, in_response_to, code=500, details='Server error'):
         return {
             'message_id': str(uuid4()),
@@ -83,69 +164,137 @@ class SatopClient:
             }
         }
     
+    def respond(self, dtype:str, req_id, func, data:dict, data_frames:list[Data], raw_msg:Data) -> tuple[str, list[bytes]]:
+        """Run a responder and encode its response, or the error it raised
+
+        Returns:
+            tuple[str, list[bytes]]: the response message and the frames following it
+        """
+        response = None
+        response_raw = None
+        response_frames = []
+        try:
+            args = self.bind_args(func, data, data_frames, raw_msg)
+
+            cache = self.caches.get(dtype)
+            data_raw = None
+            if cache:
+                cache_key = cache.key(func, args)
+                # Read before the responder runs, so a result computed from
+                # state invalidated meanwhile isn't cached
+                generation = cache.generation
+                data_raw = cache.get(cache_key)
+                registry.counter('satop_cache_requests_total', type=dtype, result='hit' if data_raw else 'miss').inc()
+
+            if data_raw is None:
+                t0 = time.perf_counter()
+                try:
+                    if self.profiler and self.profiler.wants(dtype):
+                        response_data = self.profiler.profile_request(dtype, func, args)
+                    else:
+                        response_data = func(**args)
+                finally:
+                    registry.histogram('satop_responder_seconds', type=dtype).record(time.perf_counter() - t0)
+
+                if isinstance(response_data, FramedResponse):
+                    response_frames = response_data.frames
+                    response = {
+                        'message_id': str(uuid4()),
+                        'in_response_to': req_id,
+                        'data': response_data.data,
+                        'frames': len(response_frames)
+                    }
+                elif cache:
+                    data_raw = json.dumps(response_data)
+                    cache.put(cache_key, data_raw, generation)
+                else:
+                    response = {
+                        'message_id': str(uuid4()),
+                        'in_response_to': req_id,
+                        'data': response_data
+                    }
+
+            if data_raw is not None:
+                # Splice the already encoded data into the message
+                response_raw = f'{{"message_id": "{uuid4()}", "in_response_to": {json.dumps(req_id)}, "data": {data_raw}}}'
+        except Exception as e:
+            registry.counter('satop_responder_errors_total', type=dtype).inc()
+            response = self.error_message(req_id, details=f'{e}, {e.__traceback__.tb_frame}|{e.__traceback__.tb_lasti}|{e.__traceback__.tb_lineno}')
+            trace.exception('Responder %s failed', dtype)
+        if response_raw is None:
+            response_raw = json.dumps(response)
+        return response_raw, response_frames
+
+    async def send(self, response_raw:str, frames:list[bytes]=()):
+        # Frames have to follow their message, so responses are sent one at a time
+        async with self._send_lock:
+            trace.debug('ws < %s', Summary(response_raw))
+            await self.ws.send(response_raw)
+            for frame in frames:
+                await self.ws.send(frame)
+
+    async def respond_admitted(self, queue:AdmissionQueue, dtype:str, req_id, func, *request):
+        try:
+            t0 = time.perf_counter()
+            async with queue.slots:
+                registry.histogram('satop_queue_wait_seconds', type=dtype).record(time.perf_counter() - t0)
+                response_raw, frames = await asyncio.to_thread(self.respond, dtype, req_id, func, *request)
+        finally:
+            queue.release()
+        try:
+            await self.send(response_raw, frames)
+        except websockets.ConnectionClosed:
+            trace.warning('Connection closed before responding to %s %s', dtype, req_id)
+
+    async def wait_for_queues(self):
+        """Pause reading while a queue has been full for ``pause_after`` seconds"""
+        for dtype, queue in self.queues.items():
+            if queue.full_for() >= self.pause_after:
+                trace.warning('%s queue full for %.1f s, pausing reads', dtype, queue.full_for())
+                registry.counter('satop_read_pauses_total', type=dtype).inc()
+                t0 = time.perf_counter()
+                await queue.wait_for_room()
+                registry.histogram('satop_read_pause_seconds').record(time.perf_counter() - t0)
+
     async def run(self):
+        tasks = set()
         try:
             while True:
+                await self.wait_for_queues()
                 raw_msg = await self.ws.recv()
                 msg = json.loads(raw_msg)
-                print(f'ws > {msg}')
 
                 req_id = msg.get('request_id')
                 data = msg.get('data', dict())
                 dtype = msg.get('type', data.get('type'))
-                print(f'Got request with type {dtype}')
                 extra_frames = msg.get('frames', 0)
+                trace.debug('ws > type=%s request_id=%s frames=%s data=%s', dtype, req_id, extra_frames, Summary(data))
                 data_frames = []
-                if extra_frames > 0:
-                    print(f'Will try to get additional {extra_frames} frames')
                 for i in range(extra_frames):
                     data_frames.append(await self.ws.recv())
-                    print(f'\r{i+1}/{extra_frames}', end='')
-                print()
 
                 if req_id is None or dtype is None:
                     response = self.error_message('')
                     response.pop('in_response_to')
+                    await self.send(json.dumps(response))
+                    continue
+                func = self.responders.get(dtype)
+                if not func:
+                    registry.counter('satop_requests_unknown_total').inc()
+                    await self.send(json.dumps(self.error_message(req_id, 404, 'Method not found')))
+                    continue
+
+                queue = self.queues.get(dtype)
+                if queue is None:
+                    await self.send(*self.respond(dtype, req_id, func, data, data_frames, raw_msg))
+                elif queue.try_admit():
+                    task = asyncio.create_task(self.respond_admitted(queue, dtype, req_id, func, data, data_frames, raw_msg))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
                 else:
-                    func = self.responders.get(dtype)
-                    if not func:
-                        response = self.error_message(req_id, 404, 'Method not found')
-                    else:
-                        try:
-                            type_hints = { arg: annotation.annotation for arg,annotation in signature(func).parameters.items() }
-                            if 'return' in type_hints:
-                                # Remove return value annotation
-                                type_hints.pop('return')
-                            args = {}
-                            for arg, hint in type_hints.items():
-                                if arg in data:
-                                    args[arg] = data[arg]
-                                    print(f'{arg} is named')
-                                    continue
-                                arg_type, arg_type_args = split_origin_args(hint) # e.g. list[str]  =>  list, (str,)
-                                if arg_type == list and arg_type_args == (Data,):
-                                    args[arg] = data_frames
-                                    print(f'{arg} is data_frames')
-                                elif arg_type == Data:
-                                    args[arg] = raw_msg
-                                    print(f'{arg} is raw')
-                                elif arg_type == dict:
-                                    args[arg] = data
-                                    print(f'{arg} is data')
-                                else:
-                                    print(f'{arg} is none: {split_origin_args(hint)}')
-
-                            response_data = func(**args)
-
-                            response = {
-                                'message_id': str(uuid4()),
-                                'in_response_to': req_id,
-                                'data': response_data
-                            }
-                        except Exception as e:
-                            response = self.error_message(req_id, details=f'{e}, {e.__traceback__.tb_frame}|{e.__traceback__.tb_lasti}|{e.__traceback__.tb_lineno}')
-                            traceback.print_exception(e)
-                print(f'ws < {response}')
-                await self.ws.send(json.dumps(response))
-        finally: 
-            await self.disconnect()
\ No newline at end of file
+                    registry.counter('satop_requests_rejected_total', type=dtype).inc()
+                    await self.send(json.dumps(self.error_message(req_id, 503, f'Too many {dtype} requests, try again later')))
+        finally:
+            for task in tasks:
+                task.cancel()
+            await self.disconnect()
@@ -1,9 +1,14 @@
 import datetime
 import dataclasses
+import heapq
 import threading
-import time
-from csh.csh_wrapper import CSH
+from csh.csh_pool import CSHPool
 from satop_api import SatopApi
+from telemetry import TelemetryStore
+from metrics import registry
+from tracing import get_tracer
+
+trace = get_tracer('scheduler')
 
 def utcnow():
     return datetime.datetime.now(datetime.timezone.utc)
@@ -12,19 +17,33 @@ def utcnow():
 class ScheduledElement:
     time: datetime.datetime 
     csh: list[str]
-    thread: threading.Timer
+    context: str
+    artifact_sha1: str
 
 class CSHScheduler:
+    """Runs CSH scripts at scheduled times
+
+    A single dispatcher thread waits for the next due script and starts its
+    execution in a thread of its own, so scripts for different CSH contexts
+    can run at the same time.
+    """
     api: SatopApi
-    csh_busy:bool = False
-    csh: CSH
+    pool: CSHPool
+    telemetry: TelemetryStore | None
     scheduled:dict[str, ScheduledElement]
 
 
-    def __init__(self, csh:CSH, api:SatopApi):
+    def __init__(self, pool:CSHPool, api:SatopApi, telemetry:TelemetryStore|None=None):
         self.scheduled = dict()
-        self.csh = csh
+        self.pool = pool
         self.api = api
+        self.telemetry = telemetry
+        self._queue: list[tuple[datetime.datetime, str]] = []
+        self._cond = threading.Condition()
+        self._running = True
+        self._executing: set[threading.Thread] = set()
+        self._dispatcher = threading.Thread(target=self._dispatch, name='csh-scheduler', daemon=True)
+        self._dispatcher.start()
         self.load()
         pass
 
@@ -33,29 +52,87 @@ class CSHScheduler:
         """
         pass
     
-    def add(self, start_time:datetime.datetime, commands: list[str], id: str):
+    def add(self, start_time:datetime.datetime, commands: list[str], id: str, satellite: str|None = None):
         """Add a new CSH script to schedule
 
         Args:
             start_time (datetime.datetime): _description_
             commands (list[str]): _description_
             id (str): script identifier
+            satellite (str): satellite the script is for, selects the CSH context it runs in
         """
-        dt = start_time-utcnow()
-        delta_time = (dt.seconds * (10**6) + dt.microseconds)/(10**6)
-        print(f'Adding {id} to schedule to run at {start_time} (in {delta_time} s)')
+        trace.info('Adding %s to schedule to run at %s (in %s)', id, start_time, start_time-utcnow())
 
         _, artifact_sha1 = self.api.log_received_commands(commands, start_time.timestamp())
-        t = threading.Timer(delta_time, self.execute_commands, args=(commands,id,artifact_sha1))
-        ev = ScheduledElement(
+        self._insert({id: ScheduledElement(
             time = start_time,
             csh = commands,
-            thread=t
-        )
+            context=self.pool.for_satellite(satellite).name,
+            artifact_sha1=artifact_sha1
+        )})
+
+    def add_many(self, entries: list[tuple[datetime.datetime, list[str], str, str|None]]):
+        """Add several CSH scripts to the schedule at once
 
-        self.scheduled[id] = ev
+        The scripts are logged with one batched event, identical scripts
+        sharing one artifact. Either all entries are added or, if logging
+        fails, none are.
 
-        t.start()
+        Args:
+            entries (list[tuple]): (start time, commands, script identifier, satellite) per script
+        """
+        if not entries:
+            raise ValueError('No scripts to add')
+        trace.info('Adding %s scripts to schedule', len(entries))
+        _, sha1s = self.api.log_received_commands_batch([(commands, start_time.timestamp()) for start_time, commands, _, _ in entries])
+        self._insert({
+            id: ScheduledElement(
+                time=start_time,
+                csh=commands,
+                context=self.pool.for_satellite(satellite).name,
+                artifact_sha1=sha1
+            )
+            for (start_time, commands, id, satellite), sha1 in zip(entries, sha1s)
+        })
+
+    def _insert(self, elements:dict[str, ScheduledElement]):
+        with self._cond:
+            duplicates = [id for id in elements if id in self.scheduled]
+            if duplicates:
+                raise ValueError(f'Already scheduled: {", ".join(duplicates)}')
+            self.scheduled.update(elements)
+            for id, element in elements.items():
+                heapq.heappush(self._queue, (element.time, id))
+            self._cond.notify()
+
+    def _dispatch(self):
+        with self._cond:
+            while self._running:
+                if not self._queue:
+                    self._cond.wait()
+                    continue
+                start_time, id = self._queue[0]
+                delay = (start_time - utcnow()).total_seconds()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                heapq.heappop(self._queue)
+                element = self.scheduled.get(id)
+                if element is None or element.time != start_time:
+                    # Removed, or removed and added again for another time
+                    continue
+                t = threading.Thread(target=self._execute, args=(element, id), name=f'csh-{id}', daemon=True)
+                self._executing.add(t)
+                t.start()
+
+    def _execute(self, element:ScheduledElement, id:str):
+        try:
+            self.execute_commands(element.csh, id, element.artifact_sha1)
+        except Exception:
+            trace.exception('Executing %s failed', id)
+        finally:
+            with self._cond:
+                self._executing.discard(threading.current_thread())
 
     def remove(self, id:str):
         """Remove an element from the schedule
@@ -63,47 +140,45 @@ class CSHScheduler:
         Args:
             id (str): _description_
         """
-        s = self.scheduled.get(id)
-        if s:
-            s.thread.cancel()
-            self.scheduled.pop(id)
+        with self._cond:
+            self.scheduled.pop(id, None)
 
     def execute_commands(self, commands:list[str], id:str, artifact_hash:str):
-        expected_start = self.scheduled.get(id).time
+        scheduled = self.scheduled.get(id)
+        if scheduled is None:
+            return
+        expected_start = scheduled.time
         t1 = utcnow()
         dcall = t1-expected_start
 
-        print(f'executing {id}')
-        while self.csh_busy:
-            time.sleep(1)
-
-        results = []
-
-        self.csh_busy = True
-        print(f'{id}')
-        t2 = utcnow()
-        dstart = t2-expected_start
-        self.api.log_executed_commands_start(artifact_hash, dstart)
-        for cmd in commands:
-            out, ret = self.csh.execute(cmd)
-            results.append({
-                'in': cmd,
-                'out': out.decode(),
-                'return_code': {
-                    'name': ret.name,
-                    'value': ret.value
-                },
-            })
-        self.csh_busy = False
+        trace.debug('Executing %s in CSH context %s', id, scheduled.context)
+        context = self.pool.context(scheduled.context)
+        # Scripts for other contexts run in parallel, scripts for the same
+        # context wait for it to be free
+        with context.lock:
+            t2 = utcnow()
+            dstart = t2-expected_start
+            self.api.log_executed_commands_start(artifact_hash, dstart)
+            results = context.execute_script(commands)
         t3 = utcnow()
         dexec = t3-t2
 
-        print(f'{id} | Called {dcall} after scheduled | Started {dstart} after scheduled | Took {dexec}')
+        trace.info('%s | Called %s after scheduled | Started %s after scheduled | Took %s', id, dcall, dstart, dexec)
+        registry.histogram('scheduler_call_lateness_seconds', context=context.name).record(dcall.total_seconds())
+        registry.histogram('scheduler_start_lateness_seconds', context=context.name).record(dstart.total_seconds())
+        registry.histogram('scheduler_execution_seconds', context=context.name).record(dexec.total_seconds())
+        if self.telemetry:
+            self.telemetry.ingest(results, t3.timestamp())
         self.api.log_executed_commands_finish(artifact_hash, results, dexec)
 
-        self.scheduled.pop(id)
+        self.scheduled.pop(id, None)
 
     def stop(self):
-        for s,se in self.scheduled.items():
-            self.remove(s)
-            se.thread.join()
+        with self._cond:
+            self._running = False
+            self.scheduled.clear()
+            executing = list(self._executing)
+            self._cond.notify()
+        self._dispatcher.join()
+        for t in executing:
+            t.join()
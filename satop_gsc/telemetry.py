@@ -0,0 +1,247 @@
+import dataclasses
+import os
+import re
+import threading
+import time
+from pathlib import Path
+import numpy as np
+from csh import command_name
+from metrics import registry
+from tracing import get_tracer
+
+trace = get_tracer('station')
+
+KIND_PARAM = 0
+KIND_PING = 1
+
+# One fixed size record per sample. ``value`` is NaN for text values and
+# failed pings
+RECORD = np.dtype([
+    ('time', '<f8'),
+    ('value', '<f8'),
+    ('node', '<u2'),
+    ('kind', 'u1'),
+    ('valid', 'u1'),
+    ('name', 'S32'),
+    ('unit', 'S8'),
+    ('text', 'S32'),
+])
+
+@dataclasses.dataclass
+class Sample:
+    name: str
+    node: int
+    value: float|None = None
+    text: str|None = None
+    unit: str|None = None
+    kind: int = KIND_PARAM
+
+
+_ANSI = re.compile(r'\x1b\[[0-9;]*m')
+# e.g. ' 303:2  gndwdt               = 172787 s' or 'temp_mcu@3 = 21.5'
+_PARAM = re.compile(r'^\s*(?:(?P<id>\d+):(?P<node>\d+)\s+)?(?P<name>[A-Za-z_][\w.]*)(?:@(?P<at>\d+))?\s*=\s*(?P<value>.*?)\s*$')
+_PING = re.compile(r'Ping node (?P<node>\d+).*?:\s*(?:Reply in (?P<ms>\d+)|No reply)')
+_NODE_OPTION = re.compile(r'(?:-n|--node)[\s=]+(\d+)')
+
+def _number(token:str) -> float|None:
+    try:
+        return float(int(token, 0)) if token[:2].lower() == '0x' else float(token)
+    except ValueError:
+        return None
+
+def _param_samples(name:str, node:int, value:str) -> list[Sample]:
+    if value.startswith('"'):
+        return [Sample(name, node, text=value.strip('"'))]
+    if value.startswith('['):
+        items = value.strip('[]').replace(',', ' ').split()
+        return [Sample(f'{name}[{i}]', node, _number(v), None if _number(v) is not None else v) for i, v in enumerate(items)]
+    token, _, unit = value.partition(' ')
+    number = _number(token)
+    if number is None:
+        return [Sample(name, node, text=value)]
+    return [Sample(name, node, number, unit=unit.split(maxsplit=1)[0] if unit.strip() else None)]
+
+def parse_param(cmd:str, out:str) -> list[Sample]:
+    """Parameter values printed by ``get``, ``pull``, ``list`` and ``param get``"""
+    option = _NODE_OPTION.search(cmd)
+    default_node = int(option.group(1)) if option else 0
+    samples = []
+    for line in _ANSI.sub('', out).splitlines():
+        m = _PARAM.match(line)
+        if m is None:
+            continue
+        node = m.group('node') or m.group('at')
+        samples += _param_samples(m.group('name'), int(node) if node else default_node, m.group('value'))
+    return samples
+
+def parse_ping(cmd:str, out:str) -> list[Sample]:
+    """Round trip times in ms printed by ``ping``, without a value for no reply"""
+    return [
+        Sample('ping', int(m.group('node')), float(m.group('ms')) if m.group('ms') else None, unit='ms', kind=KIND_PING)
+        for m in _PING.finditer(out)
+    ]
+
+PARSERS = {
+    'get': parse_param,
+    'pull': parse_param,
+    'list': parse_param,
+    'param': parse_param,
+    'ping': parse_ping,
+}
+
+def parse_results(results:list[dict]) -> list[Sample]:
+    """Samples in the results of ``execute_script``, from successful commands with a parser"""
+    samples = []
+    for result in results:
+        cmd = result['in']
+        parser = PARSERS.get(command_name(cmd))
+        if parser is None or result['return_code']['name'] != 'SLASH_SUCCESS':
+            continue
+        samples += parser(cmd, result['out'])
+    return samples
+
+
+class TelemetryStore:
+    """Samples in a memory mapped ring buffer of fixed size records
+
+    The oldest samples are overwritten once ``capacity`` is reached. The
+    file is reused across restarts, unless it was made with another capacity.
+
+    Args:
+        path (Path): file backing the buffer
+        capacity (int): number of samples kept
+    """
+    MAGIC = b'SATOPTLM'
+    HEADER = np.dtype([('magic', 'S8'), ('capacity', '<u8'), ('written', '<u8')])
+
+    def __init__(self, path:Path, capacity=100000):
+        self.path = Path(path)
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        size = self.HEADER.itemsize + capacity * RECORD.itemsize
+        if self.path.exists():
+            header = np.fromfile(self.path, dtype=self.HEADER, count=1)
+            if len(header) == 0 or header[0]['magic'] != self.MAGIC or header[0]['capacity'] != capacity or os.path.getsize(self.path) != size:
+                trace.warning('Recreating telemetry store %s, it has another format or capacity', self.path)
+                self.path.unlink()
+        new = not self.path.exists()
+        if new:
+            with open(self.path, 'wb') as f:
+                f.truncate(size)
+        self._header = np.memmap(self.path, dtype=self.HEADER, mode='r+', shape=(1,))
+        self._records = np.memmap(self.path, dtype=RECORD, mode='r+', offset=self.HEADER.itemsize, shape=(capacity,))
+        if new:
+            self._header[0] = (self.MAGIC, capacity, 0)
+
+        # Sample number of the newest sample of each parameter and node
+        self._latest: dict[tuple[bytes, int], int] = dict()
+        written, order = self._order()
+        self._index(written - len(order), self._records['name'][order], self._records['node'][order])
+
+    def _order(self) -> tuple[int, np.ndarray]:
+        """Samples written so far and the positions of the stored ones, oldest first"""
+        written = int(self._header[0]['written'])
+        return written, (np.arange(min(written, self.capacity)) + max(written - self.capacity, 0)) % self.capacity
+
+    def _index(self, first:int, names:np.ndarray, nodes:np.ndarray):
+        for i, key in enumerate(zip(names.tolist(), nodes.tolist()), first):
+            self._latest[key] = i
+
+    def __len__(self):
+        return int(min(self._header[0]['written'], self.capacity))
+
+    def append(self, samples:list[Sample], timestamp:float|None=None):
+        if not samples:
+            return
+        timestamp = time.time() if timestamp is None else timestamp
+        records = np.zeros(len(samples), dtype=RECORD)
+        records['time'] = timestamp
+        records['value'] = [np.nan if s.value is None else s.value for s in samples]
+        records['node'] = [s.node for s in samples]
+        records['kind'] = [s.kind for s in samples]
+        records['valid'] = [s.value is not None for s in samples]
+        records['name'] = [s.name.encode()[:32] for s in samples]
+        records['unit'] = [(s.unit or '').encode()[:8] for s in samples]
+        records['text'] = [(s.text or '').encode()[:32] for s in samples]
+        # Only the newest samples are kept from a batch larger than the buffer
+        records = records[-self.capacity:]
+
+        with self._lock:
+            written = int(self._header[0]['written'])
+            positions = (written + np.arange(len(records))) % self.capacity
+            self._records[positions] = records
+            self._header[0]['written'] = written + len(records)
+            self._index(written, records['name'], records['node'])
+        registry.counter('telemetry_samples_total').inc(len(records))
+
+    def ingest(self, results:list[dict], timestamp:float|None=None) -> int:
+        """Parse the results of ``execute_script`` and store their samples
+
+        Never raises, so storing telemetry can't fail the command execution.
+        """
+        try:
+            samples = parse_results(results)
+            self.append(samples, timestamp)
+        except Exception:
+            trace.exception('Storing telemetry failed')
+            registry.counter('telemetry_errors_total').inc()
+            return 0
+        return len(samples)
+
+    def query(self, name:str|list[str]|None=None, node:int|None=None, start:float|None=None,
+              end:float|None=None, latest=False, limit=1000) -> np.ndarray:
+        """Stored samples in time order, the newest ``limit`` of them
+
+        Args:
+            name (str|list[str]): only samples of these parameters, e.g. 'ping' for pings
+            node (int): only samples from this node
+            start (float): unix time of the first sample
+            end (float): unix time of the last sample
+            latest (bool): only the newest stored sample of each parameter and node, if it matches the other filters
+            limit (int|None): maximum number of samples, None for all
+        """
+        with self._lock:
+            written, order = self._order()
+            if latest:
+                # Forget parameters whose samples have all been overwritten
+                first = written - len(order)
+                self._latest = {k: i for k, i in self._latest.items() if i >= first}
+                order = np.sort(np.fromiter(self._latest.values(), dtype=np.int64, count=len(self._latest))) % self.capacity
+            # Columns are only read for the filters in use, and only matching
+            # records are copied out of the map
+            mask = np.ones(len(order), dtype=bool)
+            if name is not None:
+                names = [name] if isinstance(name, str) else name
+                mask &= np.isin(self._records['name'][order], [n.encode() for n in names])
+            if node is not None:
+                mask &= self._records['node'][order] == node
+            if start is not None:
+                mask &= self._records['time'][order] >= start
+            if end is not None:
+                mask &= self._records['time'][order] <= end
+            records = np.array(self._records[order[mask]])
+        return records if limit is None else records[max(len(records) - limit, 0):]
+
+    def close(self):
+        with self._lock:
+            self._records.flush()
+            self._header.flush()
+
+
+def to_records(records:np.ndarray) -> list[dict]:
+    """One dict per sample, with ISO timestamps and None for missing values"""
+    times = np.char.add(np.datetime_as_string((records['time'] * 1000).astype('datetime64[ms]'), unit='ms'), 'Z')
+    return [
+        {
+            'time': t,
+            'node': n,
+            'name': name.decode(errors='replace'),
+            'value': v if valid else None,
+            'unit': unit.decode(errors='replace') or None,
+            'text': text.decode(errors='replace') or None,
+        }
+        for t, n, name, v, valid, unit, text in zip(
+            times.tolist(), records['node'].tolist(), records['name'].tolist(), records['value'].tolist(),
+            records['valid'].tolist(), records['unit'].tolist(), records['text'].tolist()
+        )
+    ]
@@ -0,0 +1,125 @@
+import atexit
+import logging
+import os
+import queue
+import reprlib
+import sys
+from logging.handlers import QueueHandler, QueueListener
+from metrics import registry
+
+ROOT = 'satop_gsc'
+SUBSYSTEMS = ('client', 'api', 'csh', 'scheduler', 'station')
+
+OFF = logging.CRITICAL + 10
+logging.addLevelName(OFF, 'OFF')
+
+class _SummaryRepr(reprlib.Repr):
+    def __init__(self):
+        super().__init__()
+        self.maxlevel = 3
+        self.maxdict = 8
+        self.maxlist = 8
+        self.maxtuple = 8
+        self.maxstring = 200
+        self.maxother = 200
+
+    def repr_bytes(self, value, level):
+        return f'<{len(value)} bytes>'
+
+    repr_bytearray = repr_bytes
+
+_summary_repr = _SummaryRepr()
+
+class Summary:
+    """Defers a bounded repr of ``value`` until the record is actually emitted
+
+    Pass as a logging argument, e.g. ``trace.debug('ws > %s', Summary(msg))``,
+    so nothing is formatted when the level is disabled, and large payloads
+    are truncated to a few items and ``max_length`` characters.
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        if isinstance(self.value, str):
+            return _summary_repr.repr_str(self.value, 0)[1:-1]
+        return _summary_repr.repr(self.value)
+
+
+class _DroppingQueueHandler(QueueHandler):
+    def enqueue(self, record):
+        # Never block the caller, drop the record when the sink falls behind
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            registry.counter('trace_records_dropped_total').inc()
+
+
+def get_tracer(subsystem:str) -> logging.Logger:
+    return logging.getLogger(f'{ROOT}.{subsystem}')
+
+def parse_level(level:str|int) -> int:
+    if isinstance(level, int):
+        return level
+    if level.lower() == 'off':
+        return OFF
+    value = logging.getLevelName(level.upper())
+    if not isinstance(value, int):
+        raise ValueError(f'Unknown trace level {level}')
+    return value
+
+_listener: QueueListener | None = None
+_config: dict = dict()
+
+def current_config() -> dict:
+    """Arguments of the last :func:`configure` call, e.g. to configure worker processes the same way"""
+    return dict(_config)
+
+def configure(level:str|int='info', subsystems:dict[str, str|int]|None=None, max_length=200, queue_size=10000):
+    """Set up tracing output
+
+    Records are put on a bounded queue and written to stdout by a
+    background thread, so callers never block on stdout.
+
+    Args:
+        level (str|int): level for all subsystems, e.g. 'debug', 'info' or 'off'
+        subsystems (dict[str, str|int]): per-subsystem levels overriding ``level``
+        max_length (int): maximum length of summarized payloads
+        queue_size (int): records buffered before new ones are dropped
+    """
+    global _listener, _config
+    if _listener:
+        _listener.stop()
+    _config = dict(level=level, subsystems=dict(subsystems or dict()), max_length=max_length, queue_size=queue_size)
+
+    _summary_repr.maxstring = max_length
+    _summary_repr.maxother = max_length
+
+    root = logging.getLogger(ROOT)
+    root.setLevel(parse_level(level))
+    root.propagate = False
+    for name in SUBSYSTEMS:
+        get_tracer(name).setLevel(logging.NOTSET)
+    for name, sub_level in (subsystems or dict()).items():
+        get_tracer(name).setLevel(parse_level(sub_level))
+
+    # Write to a duplicate of stdout, so output isn't captured while CSH
+    # redirects file descriptor 1
+    stream = os.fdopen(os.dup(sys.stdout.fileno()), 'w', buffering=1)
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)-7s %(name)s: %(message)s'))
+
+    q = queue.Queue(queue_size)
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    root.addHandler(_DroppingQueueHandler(q))
+
+    _listener = QueueListener(q, handler)
+    _listener.start()
+
+@atexit.register
+def _flush():
+    if _listener:
+        _listener.stop()